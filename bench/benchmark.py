@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+# Benchmark the cadvisor and mesos plugins' hot path (fetch, parse, dispatch) against a local HTTP
+# stand-in serving synthetic (or recorded) payloads, with a stand-in collectd module counting the
+# values dispatched.
+#
+#   python bench/benchmark.py                          # cadvisor 10/100/1000 containers, mesos
+#   python bench/benchmark.py --containers 500 --services 200 --set stream_stats=true
+#   python bench/benchmark.py --target mesos --mesos-metrics 2000
+#   python bench/benchmark.py --cadvisor-stats stats.json   # replay a recorded payload
+#   python bench/benchmark.py --output collectd,graphite,influxdb   # compare the output paths
+#
+# phases, per interval:
+#   http     - GET of the (recursive) stats / snapshot body through the keep-alive pool
+#   json     - json.loads of that body
+#   fetch    - the plugin's fetch_metrics() (container list, fetch plan, http and parse)
+#   dispatch - the plugin's emit_metrics() of what fetch_metrics() returned (and, writing straight to
+#              graphite or influxdb, the flush of the interval's lines to the local sink)
+# objs is the net number of gc tracked objects (dicts, lists, Values...) the phase left allocated,
+# the collector is disabled while measuring.
+#
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import gc
+import imp
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+# the collectd stand-in first, then the plugins as they are laid out in /opt/collectd/python
+for path in ('src/mesos/python', 'src/cadvisor/python', 'src/common/python'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, path))
+sys.path.insert(0, BENCH_DIR)
+
+import collectd
+import payloads
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ serves the payload of the current interval, the benchmark moves it on with GET /bench/interval/<n> """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stats=None, spec=None, snapshots=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.stats = stats or []
+        self.spec = json.dumps(spec or {})
+        self.snapshots = [json.dumps(snapshot) for snapshot in snapshots or []]
+        self.interval = 0
+        self.bodies = {}
+
+    def body(self, path):
+        """ response body for path in the current interval, None for unknown paths """
+        key = (self.interval, path.split('&count=')[0].split('?count=')[0])
+        if key in self.bodies:
+            return(self.bodies[key])
+
+        body = None
+        if path.startswith('/metrics/snapshot') and self.snapshots:
+            body = self.snapshots[self.interval % len(self.snapshots)]
+        elif path.startswith('/api/v2.0/spec'):
+            body = self.spec
+        elif path.startswith('/api/v2.0/stats') and self.stats:
+            stats = self.stats[self.interval % len(self.stats)]
+            if 'recursive=true' in path:
+                body = json.dumps(stats)
+            elif path.startswith('/api/v2.0/stats/'):
+                container_id = path[len('/api/v2.0/stats/'):].split('?')[0]
+                body = json.dumps(dict((cgroup, stats[cgroup]) for cgroup in stats if container_id in cgroup))
+            else:
+                body = json.dumps({'/': stats['/']})
+        # only the current interval's bodies are kept
+        if body is not None:
+            if self.bodies and self.bodies.keys()[0][0] != self.interval:
+                self.bodies = {}
+            self.bodies[key] = body
+        return(body)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body in one write, without waiting on delayed acks (go's net/http, as used by
+    # cadvisor and mesos, sets TCP_NODELAY too)
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        if self.path.startswith('/bench/interval/'):
+            self.server.interval = int(self.path.split('/')[-1])
+            body = 'ok'
+        else:
+            body = self.server.body(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """ influxdb /write stand-in, the body is read and discarded """
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class GraphiteSink(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """ graphite plaintext stand-in, reads and discards whatever it is sent """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), GraphiteSinkHandler)
+
+
+class GraphiteSinkHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        while self.request.recv(65536):
+            pass
+
+
+def serve(server):
+    """ run the stand-in in a child process, so it does not compete for the benchmark's GIL """
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    return(process)
+
+
+class Phases(object):
+    """ per phase timings (ms) and net allocated objects across intervals """
+
+    def __init__(self):
+        self.times = {}
+        self.objects = {}
+        self.order = []
+
+    def measure(self, phase, func, *args):
+        if phase not in self.times:
+            self.order.append(phase)
+            self.times[phase] = []
+            self.objects[phase] = []
+        gc.collect()
+        gc.disable()
+        objects = gc.get_count()[0]
+        start = time.time()
+        try:
+            result = func(*args)
+        finally:
+            elapsed = time.time() - start
+            self.objects[phase].append(gc.get_count()[0] - objects)
+            gc.enable()
+        self.times[phase].append(elapsed * 1000)
+        return(result)
+
+    def summary(self):
+        rows = []
+        for phase in self.order:
+            times = self.times[phase]
+            rows.append({'phase': phase, 'mean_ms': sum(times) / len(times), 'min_ms': min(times), 'max_ms': max(times),
+                         'objs': sum(self.objects[phase]) / len(self.objects[phase])})
+        return(rows)
+
+
+def load_plugin(name, filename):
+    return(imp.load_source(name, os.path.join(ROOT_DIR, filename)))
+
+
+def output_config(output, server, sink):
+    """ the output setting for one of --output, None for collectd """
+    if output == 'graphite':
+        return({'type': 'graphite', 'host': '127.0.0.1', 'port': sink.server_address[1], 'hostname': 'bench'})
+    if output == 'influxdb':
+        return({'type': 'influxdb', 'host': '127.0.0.1', 'port': server.server_address[1], 'hostname': 'bench'})
+    return(None)
+
+
+def run_cadvisor(args, containers, output):
+    if args.cadvisor_stats:
+        recorded = payloads.load(args.cadvisor_stats)
+        stats = [recorded]
+        spec = dict((cgroup, {'namespace': 'docker', 'aliases': [cgroup.split('/')[-1]]} if 'docker' in cgroup else {}) for cgroup in recorded)
+        label = 'cadvisor recorded={}'.format(args.cadvisor_stats)
+    else:
+        tree = payloads.cgroups(containers, args.services)
+        stats = [payloads.cadvisor_stats(tree, i + 1, cpus=args.cpus, count=args.samples) for i in range(args.intervals + 1)]
+        spec = payloads.cadvisor_spec(tree)
+        label = 'cadvisor containers={} services={}'.format(containers, args.services)
+    label = '{} output={}'.format(label, output)
+
+    server = StandInServer(stats=stats, spec=spec)
+    port = server.server_address[1]
+    process = serve(server)
+    sink = GraphiteSink()
+    sink_process = serve(sink)
+
+    with open(os.path.join(ROOT_DIR, 'etc-collectd/cadvisor.yaml.example'), 'r') as f:
+        config = yaml.safe_load(f)
+    # containers are listed from cadvisor, there is no docker daemon to ask
+    config.update({'docker_source': 'cadvisor', 'docker_events': False, 'targets': None, 'targets_file': None})
+    config.update(args.overrides)
+    config['output'] = output_config(output, server, sink)
+
+    plugin = load_plugin('cadvisor_metrics', 'src/cadvisor/python/cadvisor-metrics.py')
+    client = plugin.CAdvisorMetrics({'host': '127.0.0.1', 'port': port, 'config_data': config})
+    recursive = '/api/v2.0/stats?recursive=true&count={}'.format(args.samples)
+
+    result = measure(args, client, server, label, lambda: client.http_pool.fetch('127.0.0.1', port, recursive, 30),
+                     client.fetch_metrics, emitter(client, lambda: client.values_dispatched, cumulative=False))
+    process.terminate()
+    sink_process.terminate()
+    return(result)
+
+
+def run_mesos(args, output):
+    config_file = os.path.join(ROOT_DIR, 'etc-collectd/mesos.yaml.example')
+    if args.mesos_snapshot:
+        snapshots = [payloads.load(args.mesos_snapshot)]
+        label = 'mesos recorded={}'.format(args.mesos_snapshot)
+    else:
+        snapshots = [payloads.mesos_snapshot(config_file, args.mesos_metrics, i) for i in range(args.intervals + 1)]
+        label = 'mesos metrics={}'.format(args.mesos_metrics)
+    label = '{} output={}'.format(label, output)
+
+    server = StandInServer(snapshots=snapshots)
+    port = server.server_address[1]
+    process = serve(server)
+    sink = GraphiteSink()
+    sink_process = serve(sink)
+
+    plugin = load_plugin('mesos_master', 'src/mesos/python/mesos-master.py')
+    client = plugin.MesosMaster({'host': '127.0.0.1', 'port': port, 'master': True, 'config_file': config_file,
+                                 'tracking_name': 'mesos.master', 'output': output_config(output, server, sink)})
+    if client.writer is None:
+        values = lambda: collectd.dispatched['calls']
+    else:
+        values = lambda: client.writer.counters['lines']
+    emit = emitter(client, values)
+
+    result = measure(args, client, server, label, lambda: client.http_pool.fetch('127.0.0.1', port, client.path, 30),
+                     client.fetch_metrics, emit)
+    process.terminate()
+    sink_process.terminate()
+    return(result)
+
+
+def emitter(client, values, cumulative=True):
+    """
+    emit_metrics(), followed by the flush of the interval when writing straight to graphite/influxdb,
+    returning the number of values output (values() is a running total, or per emit)
+    """
+    def emit(metrics):
+        before = values() if cumulative else 0
+        client.emit_metrics(metrics)
+        if client.writer is not None:
+            client.writer.flush()
+        return(values() - before)
+    return(emit)
+
+
+def measure(args, client, server, label, raw_fetch, fetch, emit):
+    """ run the intervals (the first one, interval 0, is a warm up and not measured), emit() returns the values output """
+    host, port = server.server_address
+    phases = Phases()
+    values = []
+    body_bytes = []
+    for interval in range(args.intervals + 1):
+        client.http_pool.fetch(host, port, '/bench/interval/{}'.format(interval), 30)
+        if interval == 0:
+            emit(fetch())
+            continue
+
+        body = phases.measure('http', raw_fetch)
+        body_bytes.append(len(body))
+        phases.measure('json', json.loads, body)
+        body = None
+
+        metrics = phases.measure('fetch', fetch)
+        values.append(phases.measure('dispatch', emit, metrics))
+
+    summary = phases.summary()
+    dispatch_ms = sum(row['mean_ms'] for row in summary if row['phase'] == 'dispatch')
+    values = sum(values) / max(1, len(values))
+    return({'label': label, 'intervals': args.intervals, 'bytes': sum(body_bytes) / max(1, len(body_bytes)),
+            'values': values, 'values_per_sec': int(values * 1000 / dispatch_ms) if dispatch_ms else 0, 'phases': summary,
+            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def report(result):
+    print('{}  intervals={}  bytes={}  values/interval={}  dispatch values/s={}'.format(result['label'], result['intervals'], result['bytes'],
+                                                                                        result['values'], result['values_per_sec']))
+    print('  {:<10} {:>10} {:>10} {:>10} {:>10}'.format('phase', 'mean ms', 'min ms', 'max ms', 'objs'))
+    for row in result['phases']:
+        print('  {phase:<10} {mean_ms:>10.2f} {min_ms:>10.2f} {max_ms:>10.2f} {objs:>10}'.format(**row))
+    print('  maxrss {} KB'.format(result['maxrss_kb']))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the cadvisor and mesos collectd plugins')
+    parser.add_argument('--target', choices=('cadvisor', 'mesos', 'all'), default='all')
+    parser.add_argument('--containers', default='10,100,1000', help='comma separated container counts (default 10,100,1000)')
+    parser.add_argument('--services', type=int, default=50, help='systemd units in the synthetic cgroup tree')
+    parser.add_argument('--cpus', type=int, default=4, help='cpus in per_cpu_usage')
+    parser.add_argument('--samples', type=int, default=1, help='samples per cgroup (count=)')
+    parser.add_argument('--intervals', type=int, default=10, help='measured intervals per run')
+    parser.add_argument('--mesos-metrics', type=int, default=500, help='metrics in the synthetic mesos snapshot')
+    parser.add_argument('--cadvisor-stats', help='replay a recorded /api/v2.0/stats?recursive=true response instead')
+    parser.add_argument('--mesos-snapshot', help='replay a recorded /metrics/snapshot response instead')
+    parser.add_argument('--output', default='collectd', help='comma separated outputs to compare: collectd, graphite, influxdb (default collectd)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='cadvisor.yaml override, value is yaml')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--verbose', action='store_true', help='show plugin log messages')
+    args = parser.parse_args()
+
+    collectd.verbose = args.verbose
+    args.overrides = {}
+    for setting in args.set:
+        key, sep, value = setting.partition('=')
+        args.overrides[key] = yaml.safe_load(value)
+
+    outputs = args.output.split(',')
+    for output in outputs:
+        if output not in ('collectd', 'graphite', 'influxdb'):
+            parser.error('unknown output "{}"'.format(output))
+
+    results = []
+    if args.target in ('cadvisor', 'all'):
+        counts = [0] if args.cadvisor_stats else [int(count) for count in args.containers.split(',')]
+        for containers in counts:
+            for output in outputs:
+                results.append(run_cadvisor(args, containers, output))
+                if not args.json:
+                    report(results[-1])
+    if args.target in ('mesos', 'all'):
+        for output in outputs:
+            results.append(run_mesos(args, output))
+            if not args.json:
+                report(results[-1])
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
+
+# END
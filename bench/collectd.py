@@ -0,0 +1,72 @@
+#
+# Minimal stand-in for the collectd python module, for running the plugins outside of collectd (benchmark)
+# values are counted, not sent anywhere
+#
+
+import sys
+
+verbose = False
+dispatched = {'values': 0, 'calls': 0}
+
+
+class Values(object):
+
+    def __init__(self, **kwargs):
+        self.host = ''
+        self.plugin = ''
+        self.plugin_instance = ''
+        self.type = ''
+        self.type_instance = ''
+        self.values = []
+        self.time = 0
+        self.interval = 0
+        self.meta = {}
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+    def dispatch(self, **kwargs):
+        dispatched['calls'] += 1
+        dispatched['values'] += len(kwargs.get('values', self.values))
+
+
+def _log(level, message):
+    if verbose:
+        sys.stderr.write('{} -- {}\n'.format(level, message))
+
+
+def error(message):
+    _log('ERR', message)
+
+
+def warning(message):
+    _log('WARN', message)
+
+
+def notice(message):
+    _log('NOTICE', message)
+
+
+def info(message):
+    _log('INFO', message)
+
+
+def debug(message):
+    _log('DEBUG', message)
+
+
+def register_config(callback, *args, **kwargs):
+    pass
+
+
+def register_read(callback, *args, **kwargs):
+    pass
+
+
+def register_init(callback, *args, **kwargs):
+    pass
+
+
+def register_shutdown(callback, *args, **kwargs):
+    pass
+
+# END
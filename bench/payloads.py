@@ -0,0 +1,137 @@
+#
+# Synthetic cadvisor /api/v2.0/stats and mesos /metrics/snapshot payloads for the benchmark
+#
+# every interval gets its own payload with the counters and timestamps moved on, so rates,
+# change-only emission and backfill behave as they would against a live endpoint.
+#
+
+import datetime
+import hashlib
+import json
+import math
+
+import yaml
+
+EPOCH = datetime.datetime(2016, 1, 1)
+
+
+def timestamp(seconds, offset=0):
+    """
+    RFC 3339 timestamp with nanoseconds, like cadvisor's, for a number of seconds (may be negative or
+    fractional) and ns offset past EPOCH. later times always give later timestamps, however far apart
+    """
+    whole = int(math.floor(seconds))
+    nanoseconds = int(round((seconds - whole) * 1e9)) + offset
+    whole += nanoseconds // 1000000000
+    moment = EPOCH + datetime.timedelta(seconds=whole)
+    return('{}.{:09d}Z'.format(moment.strftime('%Y-%m-%dT%H:%M:%S'), nanoseconds % 1000000000))
+
+
+def container_id(n):
+    return(hashlib.sha256('container-{}'.format(n)).hexdigest())
+
+
+def device_stats(step, keys):
+    return([{'major': 8, 'minor': minor, 'stats': dict((key, 1000 * (minor + 1) + step * 17) for key in keys)} for minor in (0, 16)])
+
+
+def sample(n, interval, seconds, cpus, filesystem=False):
+    """ one stats sample for cgroup n """
+    step = interval + n
+    stats = {
+        'timestamp': timestamp(seconds, n * 7919),
+        'has_cpu': True,
+        'cpu': {
+            'usage': {
+                'total': 5000000 * step,
+                'user': 3000000 * step,
+                'system': 2000000 * step,
+                'per_cpu_usage': [1250000 * step + cpu for cpu in range(cpus)],
+            },
+            'load_average': n % 3,
+        },
+        'has_memory': True,
+        'memory': {
+            'usage': 104857600 + 4096 * step,
+            'working_set': 52428800 + 4096 * step,
+            'container_data': {'pgfault': 1000 * step, 'pgmajfault': 3},
+            'hierarchical_data': {'pgfault': 2000 * step, 'pgmajfault': 5},
+        },
+        'has_network': True,
+        'network': {
+            'interfaces': [dict([('name', 'eth0')] + [('{}_{}'.format(direction, item), 100 * step) for direction in ('rx', 'tx') for item in ('bytes', 'packets', 'errors', 'dropped')])],
+        },
+        'has_diskio': True,
+        'diskio': {
+            'io_service_bytes': device_stats(step, ('Async', 'Read', 'Sync', 'Total', 'Write')),
+            'io_serviced': device_stats(step, ('Async', 'Read', 'Sync', 'Total', 'Write')),
+            'io_merged': device_stats(step, ('Async', 'Read', 'Sync', 'Total', 'Write')),
+            'io_queued': device_stats(0, ('Async', 'Read', 'Sync', 'Total', 'Write')),
+            'io_service_time': device_stats(step, ('Async', 'Read', 'Sync', 'Total', 'Write')),
+            'io_wait_time': device_stats(step, ('Async', 'Read', 'Sync', 'Total', 'Write')),
+            'io_time': device_stats(step, ('Count',)),
+            'sectors': device_stats(step, ('Count',)),
+        },
+        'has_load': True,
+        'load_stats': {'nr_sleeping': n % 5, 'nr_running': 1, 'nr_stopped': 0, 'nr_uninterruptible': 0, 'nr_io_wait': 0},
+        'has_filesystem': filesystem,
+    }
+    if filesystem:
+        device = dict((key, 1000 * step) for key in ('read_time', 'io_time', 'weighted_io_time', 'write_time', 'writes_completed',
+                                                       'reads_completed', 'writes_merged', 'sectors_written', 'reads_merged', 'sectors_read'))
+        device.update({'device': '/dev/sda1', 'capacity': 107374182400, 'usage': 10737418240 + 4096 * step, 'io_in_progress': 0})
+        stats['filesystem'] = [device]
+    return(stats)
+
+
+def cgroups(containers, services):
+    """ the cgroup tree, [(cgroup, container id or None, container name or None)] """
+    tree = [('/', None, None), ('/system.slice', None, None), ('/user.slice', None, None),
+            ('/system.slice/-.mount', None, None), ('/system.slice/docker.socket', None, None)]
+    for n in range(services):
+        tree.append(('/system.slice/unit-{}.service'.format(n), None, None))
+    for n in range(containers):
+        cid = container_id(n)
+        tree.append(('/system.slice/docker-{}.scope'.format(cid), cid, 'container-{}'.format(n)))
+    return(tree)
+
+
+def cadvisor_stats(tree, interval, period=10, cpus=4, count=1):
+    """ recursive stats for every cgroup in the tree, count samples per cgroup (newest last) """
+    stats = {}
+    for n, (cgroup, cid, name) in enumerate(tree):
+        samples = []
+        for i in range(count):
+            back = count - 1 - i
+            samples.append(sample(n, interval - back, (interval - back) * period, cpus, cgroup == '/'))
+        stats[cgroup] = samples
+    return(stats)
+
+
+def cadvisor_spec(tree):
+    """ recursive spec, only what the plugin reads (namespace, aliases) """
+    spec = {}
+    for cgroup, cid, name in tree:
+        spec[cgroup] = {'namespace': 'docker', 'aliases': [name, cid]} if cid else {}
+    return(spec)
+
+
+def mesos_snapshot(config_file, metrics, interval):
+    """ a /metrics/snapshot with every metric named in mesos.yaml plus generic ones up to 'metrics' entries """
+    with open(config_file, 'r') as f:
+        names = [name for name in yaml.safe_load(f) if '/' in name]
+    n = 0
+    while len(names) < metrics:
+        names.append('master/framework_{}/tasks_running'.format(n))
+        n += 1
+    snapshot = dict((name, float(i * 10 + interval)) for i, name in enumerate(names[0:max(metrics, 1)]))
+    snapshot['master/elected'] = 1.0
+    return(snapshot)
+
+
+def load(filename):
+    """ a recorded payload (e.g. curl -s http://cadvisor:8080/api/v2.0/stats?recursive=true > stats.json) """
+    with open(filename, 'r') as f:
+        return(json.load(f))
+
+# END
@@ -1,6 +1,13 @@
 from __future__ import print_function
 from cadvisor import CAdvisor
+from direct_writer import shared_writer
+from multi_target import MultiTarget
+from prefetch import Prefetcher
+from profiler import ReadProfiler
+from resilience import TransientError
 import collectd
+import sys
+import time
 
 
 class CAdvisorMetrics(CAdvisor):
@@ -8,6 +15,12 @@ class CAdvisorMetrics(CAdvisor):
     def __init__(self, config):
         super(CAdvisorMetrics, self).__init__(config)
         self.name = self.__class__.__name__
+        # output in cadvisor.yaml, values written straight to graphite/influxdb instead of dispatched to collectd
+        try:
+            self.writer = shared_writer(self.config.get('output', None), self.log_error)
+        except ValueError, e:
+            self.log_error('Invalid output configuration: {}. See documentation: {}'.format(e, self.doc_url))
+            sys.exit(1)
         self.log_info('Configured {} plugin.'.format(self.name))
 
     def log_error(self, msg):
@@ -25,9 +38,27 @@ class CAdvisorMetrics(CAdvisor):
     def log_debug(self, msg):
         collectd.debug(msg)
 
-    def dispatch_metric(self, container_name, container_id, plugin, plugin_instance, metric_type, type_instance, metric_value):
+    def gen_series_name(self, container_name, container_id, plugin, plugin_instance, metric_type, type_instance):
+        """
+        a collectd.Values with everything but the value(s) already set,
+        cached per series by series_name() and reused for every dispatch of the series
+        (or the writer's series, container name and id are tags rather than part of the plugin name,
+        unless the writer does not do tags)
+        """
+        if self.writer is not None:
+            hostname = self.gen_host_name(self.target_name or self.writer.hostname, container_name, container_id)
+            if not self.writer.tagged:
+                plugin = self.gen_plugin_name(None, container_name, container_id, plugin)
+                return(self.writer.series(hostname, plugin, plugin_instance, metric_type, type_instance))
+            return(self.writer.series(hostname, plugin, plugin_instance, metric_type, type_instance,
+                                      {'container_name': container_name, 'container_id': container_id}))
+
         metric = collectd.Values()
 
+        # remote targets, the metrics belong to the host cadvisor is running on
+        if self.target_name:
+            metric.host = self.gen_host_name(self.target_name, container_name, container_id)
+
         #
         # BUG  there isn't an easy way for a plugin to determine what hostname collectd is actually using.
         # the value is NOT passed to plugins, only commands run by the exec plugin. so, there is no way
@@ -45,14 +76,55 @@ class CAdvisorMetrics(CAdvisor):
         if type_instance:
             metric.type_instance = type_instance
 
+        return(metric)
+
+    def dispatch_metric(self, container_name, container_id, plugin, plugin_instance, metric_type, type_instance, metric_value):
+        metric = self.series_name(container_name, container_id, plugin, plugin_instance, metric_type, type_instance)
+        if self.writer is not None:
+            self.writer.write(metric, self.dispatch_time, metric_value)
+            return
         metric.values = metric_value
+        metric.time = self.dispatch_time or 0
         metric.dispatch()
 
+    def dispatch_batch(self, container_name, container_id, records):
+        # the container's series names are looked up once for the batch
+        container_key = (container_name, container_id)
+        names = self.series_names.get(container_key, None)
+        if names is None:
+            names = self.series_names[container_key] = {}
+        gen_series_name = self.gen_series_name
+        dispatch_time = self.dispatch_time
+
+        if self.writer is not None:
+            items = []
+            for record in records:
+                series_key = record[0:4]
+                metric = names.get(series_key, None)
+                if metric is None:
+                    metric = names[series_key] = gen_series_name(container_name, container_id, *series_key)
+                items.append((metric, record[4]))
+            self.writer.write_all(items, dispatch_time)
+            return
+
+        dispatch_time = dispatch_time or 0
+        for record in records:
+            series_key = record[0:4]
+            metric = names.get(series_key, None)
+            if metric is None:
+                metric = names[series_key] = gen_series_name(container_name, container_id, *series_key)
+            metric.values = record[4]
+            metric.time = dispatch_time
+            metric.dispatch()
+
 #
 # CAdvisor metrics plugin for collectd python
 #
 
 client = None
+collector = None
+prefetcher = None
+profiler = None
 
 
 def configurator(collectd_conf):
@@ -63,7 +135,7 @@ def configurator(collectd_conf):
         port: port of target mesos host
         config_file: path to cadvisor.yaml
     """
-    global client
+    global client, collector, prefetcher, profiler
 
     collectd.info('Loading CAdvisorMetrics plugin')
 
@@ -82,10 +154,58 @@ def configurator(collectd_conf):
 
     client = CAdvisorMetrics(config)
 
+    # targets/targets_file in cadvisor.yaml, poll every listed cadvisor instead of (only) Host
+    if client.targets or client.targets_file:
+        def target_client(target):
+            return(CAdvisorMetrics(dict(config, host=target['host'], port=target['port'], target_name=target['name'], config_data=client.config)))
+        collector = MultiTarget(target_client, 8080, client.targets, client.targets_file, client.target_workers, 'prefetch_metrics', client.log_error)
+
+    if client.prefetch:
+        fetch = collector.fetch if collector else client.prefetch_metrics
+        prefetcher = Prefetcher(fetch, client.prefetch_lead, client.prefetch_max_age, client.log_error)
+
+    if client.profile or client.profile_trigger_file:
+        profiler = ReadProfiler(client.profile_output, client.profile_intervals, client.profile_trigger_file, client.profile,
+                                client.log_info, client.log_error)
+
 
 def reader():
-    global client
-    client.emit_metrics(client.fetch_metrics())
+    global profiler
+    if profiler is not None:
+        profiler.run(read)
+    else:
+        read()
+
+
+def read():
+    global client, collector, prefetcher
+    start = time.time()
+    if prefetcher is not None:
+        # only dispatch the snapshot fetched ahead of this read, never wait on cadvisor
+        metrics = prefetcher.collect()
+        if metrics is None:
+            client.log_warning('No new cadvisor snapshot ready, interval skipped {}'.format(prefetcher.counters))
+    elif collector is not None:
+        metrics = collector.fetch()
+    else:
+        try:
+            metrics = client.fetch_metrics()
+        except TransientError, e:
+            # cadvisor restarting, docker busy... try again next interval
+            client.log_warning('Interval skipped: {}'.format(e))
+            metrics = None
+
+    if metrics is not None:
+        if collector is not None:
+            collector.emit(metrics)
+        else:
+            client.emit_metrics(metrics)
+
+    if client.self_metrics:
+        client.emit_read_metrics(time.time() - start, prefetcher, client.writer)
+
+    if client.writer is not None:
+        client.writer.flush()
 
 
 collectd.register_config(configurator)
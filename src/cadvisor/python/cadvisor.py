@@ -11,18 +11,63 @@ import yaml
 import urllib2
 import socket
 import docker
+import calendar
+import math
 import re
+import time
+
+from docker_inventory import DockerInventory
+from http_pool import shared_pool
+from change_filter import ChangeFilter
+from json_stream import iter_object_items
+from rates import RateEngine
+from aggregate import AGGREGATES, CounterArrays, summarize
+from resilience import CircuitBreaker, TransientError, retry
 
 
 class CAdvisor(object):
     """ Abstract base class for gathering host and container metrics """
     __metaclass__ = ABCMeta
 
+    #
+    # fields which can be selected in each metrics_<group> list
+    # and the selectors which expand to several fields (or are alternate spellings)
+    #
+    METRIC_FIELDS = {
+        'cpu': ('load_average', 'system', 'total', 'user', 'per_cpu_usage'),
+        'diskio': ('io_merged', 'io_queued', 'io_service_bytes', 'io_service_time', 'io_serviced', 'io_time', 'io_wait_time', 'sectors'),
+        'load_stats': ('nr_sleeping', 'nr_running', 'nr_stopped', 'nr_uninterruptible', 'nr_io_wait'),
+        'memory': ('usage', 'working_set', 'container_data', 'hierarchical_data'),
+        'network': ('bytes', 'dropped', 'errors', 'packets'),
+    }
+    METRIC_FIELD_ALIASES = {
+        'cpu': {'usage': ('system', 'total', 'user', 'per_cpu_usage')},
+        'memory': {'hierarchial_data': ('hierarchical_data',)},
+        # rx and tx are dispatched together (collectd if_* types are rx:tx pairs)
+        'network': dict(('{}_{}'.format(direction, item), (item,)) for direction in ('rx', 'tx') for item in ('bytes', 'dropped', 'errors', 'packets')),
+    }
+
+    # the metric groups with cumulative counters which can be turned into rates, and their plugin names
+    RATE_GROUPS = {'cpu': 'cpu', 'diskio': 'blkio', 'network': 'net'}
+
+    # container name and id, and plugin, the plugin's own metrics (self_metrics) are dispatched as
+    COLLECTOR = ('cadvisor', 0)
+    COLLECTOR_PLUGIN = 'collector'
+
+    # plugin instance of the per cpu aggregates (min, max, avg, p95), per_cpu_mode aggregate/both
+    PER_CPU_AGGREGATE = 'all'
+
+    # container name and id the containers outside the top max_containers are summed into,
+    # docker container names cannot start with '_' so it never matches a real container
+    OTHER = ('_other', 0)
+
     def __init__(self, config):
         """
         host: string, 'ip' or 'docker/(name|id)' of docker container running cadvisor
         port: optional, string (quote Port: in collectd config otherwise it comes through as a float)
         config_file: pathspec for the full yaml config of this plugin
+        config_data: optional, the already parsed config_file (clients created for multiple targets)
+        target_name: optional, name (host) of a remote cadvisor target, see targets in cadvisor.yaml
         """
         super(CAdvisor, self).__init__()
         self.name = self.__class__.__name__
@@ -42,8 +87,11 @@ class CAdvisor(object):
 
         try:
             # self.log_info('Parsing configuration {}'.format(self.config_file))
-            f = open(self.config_file, 'r')
-            self.config = yaml.load(f)
+            if 'config_data' in config:
+                self.config = config['config_data']
+            else:
+                f = open(self.config_file, 'r')
+                self.config = yaml.load(f)
         except Exception, e:
             self.log_error('Unable to load configuration "{}": {}'.format(self.config_file, e))
             sys.exit(1)
@@ -51,6 +99,7 @@ class CAdvisor(object):
         self.docker_socket = self.config.get('docker_socket', '/var/run/docker.sock')
 
         self.active_metrics = self.get_active_metrics()
+        self.metric_plan = self.get_metric_plan()
 
         self.system_enabled = self.config.get('system_enabled', False)
         self.system_fs_metrics = self.config.get('system_fs_metrics', False)
@@ -87,6 +136,10 @@ class CAdvisor(object):
             self.log_error('No service filter configuration identified. See documentation: {}'.format(self.doc_url))
             sys.exit(1)
 
+        # include/exclude compiled into one matcher, and the outcome cached per cgroup path
+        self.service_match = self.compile_service_patterns(self.system_services['include' if self.service_filter == 'include' else 'exclude'])
+        self.service_decisions = {}
+
         self.docker_enabled = self.config.get('docker_enabled', True)
         self.docker_container_config = self.config.get('docker_containers', [])
         if type(self.docker_container_config).__name__ != 'list':
@@ -99,6 +152,170 @@ class CAdvisor(object):
         self.host_namespec = self.config.get('ns_host', '{hn}')
         self.plugin_namespec = self.config.get('ns_plugin', '{cn}.')
 
+        # names are identical interval to interval, they are formatted once and cached
+        #   series_names: (container name, container id) -> series -> name(s), evicted when the container goes away
+        #   instance_names: plugin/type instance strings built from metric structure (devices, interfaces, cpus...)
+        self.series_names = {}
+        self.instance_names = {}
+        self.containers_seen = set()
+
+        # cumulative counters as-is (raw), as per second rates (rate), or both
+        # rates are dispatched with type <type>_rate (see cadvisor-types.db)
+        rates = self.config.get('rates', None) or {}
+        self.rate_mode = str(rates.get('mode', 'raw')).lower()
+        if self.rate_mode not in ('raw', 'rate', 'both'):
+            self.log_error('Invalid rates mode "{}", expected raw, rate or both. See documentation: {}'.format(self.rate_mode, self.doc_url))
+            sys.exit(1)
+        self.rate_plugins = set(self.RATE_GROUPS[group] for group in rates.get('groups', self.RATE_GROUPS.keys()) if group in self.RATE_GROUPS)
+        self.rate_engine = RateEngine() if self.rate_mode != 'raw' else None
+        self.sample_time = None
+
+        # wide hosts: per_cpu_usage as a series per cpu, as aggregates across the cpus (min/max/avg/p95
+        # of the per cpu rates, plugin instance 'all'), or both. diskio as a series per device, as totals
+        # across the devices (plugin instance 'total'), or both
+        self.per_cpu_mode = str(self.config.get('per_cpu_mode', 'series')).lower()
+        if self.per_cpu_mode not in ('series', 'aggregate', 'both'):
+            self.log_error('Invalid per_cpu_mode "{}", expected series, aggregate or both. See documentation: {}'.format(self.per_cpu_mode, self.doc_url))
+            sys.exit(1)
+        self.per_cpu_rates = CounterArrays() if self.per_cpu_mode != 'series' else None
+        self.diskio_mode = str(self.config.get('diskio_mode', 'series')).lower()
+        if self.diskio_mode not in ('series', 'total', 'both'):
+            self.log_error('Invalid diskio_mode "{}", expected series, total or both. See documentation: {}'.format(self.diskio_mode, self.doc_url))
+            sys.exit(1)
+        # the (container name, container id) being output
+        self.container_key = None
+
+        # cardinality guard, at most max_containers containers are output in full, ranked by rank_by
+        # (cpu: usage rate since the previous interval, memory: working set). the rest are summed into
+        # the OTHER container, with their cumulative counters summed as per second rates (other_rates)
+        #   container_ranks: (container name, container id) -> (timestamp, cpu usage) of the previous interval
+        self.max_containers = int(self.config.get('max_containers', 0) or 0)
+        self.rank_by = str(self.config.get('rank_by', 'cpu')).lower()
+        if self.rank_by not in ('cpu', 'memory'):
+            self.log_error('Invalid rank_by "{}", expected cpu or memory. See documentation: {}'.format(self.rank_by, self.doc_url))
+            sys.exit(1)
+        self.container_ranks = {}
+        self.other_rates = RateEngine() if self.max_containers > 0 else None
+
+        # stamp dispatched values with the time cadvisor took the sample rather than the time of
+        # dispatch (which includes the fetch and parse latency), dispatch_time is the time to use (None for
+        # the time of dispatch: backends pass Values.time 0 or PUTVAL N and collectd stamps the value).
+        # cadvisor's dynamic housekeeping can return the same newest sample on consecutive reads, which
+        # collectd rejects ("value too old"), so series whose sample has not moved on are skipped
+        #   dispatch_times: (container name, container id) -> series key -> last time dispatched with
+        self.sample_timestamps = self.config.get('sample_timestamps', False)
+        self.timestamp_cache = {}
+        self.dispatch_time = None
+        self.dispatch_times = {}
+
+        # change-only emission, values which have not moved by more than change_deadband (fraction of
+        # the value last sent) are suppressed, but still sent at least every change_heartbeat intervals
+        self.change_filter = None
+        if self.config.get('change_only', False):
+            self.change_filter = ChangeFilter(self.config.get('change_deadband', 0), self.config.get('change_heartbeat', 10))
+
+        # backfill, after a missed interval request enough history (count=N) to cover the gap
+        # and dispatch the samples in between with their own timestamps
+        #   sample_times: (container name, container id) -> timestamp of the newest sample output
+        #   read_interval: learned from the spacing of fetches, housekeeping_interval from the spacing of samples
+        self.backfill = self.config.get('backfill', False)
+        self.backfill_max_samples = max(1, int(self.config.get('backfill_max_samples', 10)))
+        self.housekeeping_interval = float(self.config.get('backfill_housekeeping_interval', 1.0))
+        self.read_interval = None
+        self.last_fetch = None
+        self.fetch_count = 1
+        self.sample_times = {}
+
+        # the plugin's own cost (fetch, parse, docker, emit times, bytes, cgroups and values), dispatched
+        # every interval under COLLECTOR_PLUGIN. collector_stats holds the figures of the current run
+        self.self_metrics = self.config.get('self_metrics', False)
+        self.collector_stats = {}
+        self.values_dispatched = 0
+        self.fetch_complete = True
+
+        # persistent connections to cadvisor (shared with any other plugin instances)
+        self.http_pool = shared_pool(self.config.get('http_pool_size', None), self.config.get('http_idle_timeout', None))
+
+        # fetch in the background, ahead of each read (plugin mode only)
+        self.prefetch = self.config.get('prefetch', False)
+        self.prefetch_lead = self.config.get('prefetch_lead', 1.0)
+        self.prefetch_max_age = self.config.get('prefetch_max_age', None)
+
+        # profile the read callback (plugin mode only), from startup and/or whenever profile_trigger_file appears
+        self.profile = self.config.get('profile', False)
+        self.profile_intervals = self.config.get('profile_intervals', 10)
+        self.profile_trigger_file = self.config.get('profile_trigger_file', None)
+        self.profile_output = self.config.get('profile_output', '/tmp/cadvisor-collectd-{pid}-{time}.prof')
+
+        # parse (and emit) the stats one cgroup at a time rather than loading the whole response
+        self.stream_stats = self.config.get('stream_stats', False)
+
+        # fetch planning, one recursive request for the whole cgroup tree or targeted requests
+        # for only the cgroups which will be emitted. 'auto' picks the cheaper, by measured cost.
+        self.fetch_mode = str(self.config.get('fetch_mode', 'auto')).lower()
+        if self.fetch_mode not in ('auto', 'recursive', 'targeted'):
+            self.log_error('Invalid fetch_mode "{}", expected auto, recursive or targeted. See documentation: {}'.format(self.fetch_mode, self.doc_url))
+            sys.exit(1)
+        self.fetch_probe_interval = self.config.get('fetch_probe_interval', 60)
+        self.fetch_cost = {}
+        self.fetch_runs = 0
+        self.docker_container_list = []
+        self.docker_inventory_version = None
+
+        # docker_containers compiled for matching, names (with leading '/') and id prefixes grouped by length
+        self.container_match_all = '*' in self.docker_container_config
+        self.container_match_names = set()
+        self.container_match_ids = {}
+        for target in self.docker_container_config:
+            if target == '*':
+                continue
+            if self.is_container_id(target):
+                self.container_match_ids.setdefault(len(target), set()).add(target)
+            else:
+                self.container_match_names.add(self.fix_container_name(target))
+
+        # container id -> selected container, rebuilt only when the container list changes
+        # cgroup path -> container id (or None), so each cgroup is only searched for an id once
+        self.container_index = None
+        self.cgroup_container_ids = {}
+        self.container_id_re = re.compile('[0-9a-f]{64}')
+
+        # multiple targets, one plugin instance polling many cadvisor endpoints
+        #   target_name is set on each of the per target clients, whose docker containers
+        #   are listed by their cadvisor (the local docker socket knows nothing about them)
+        self.targets = self.config.get('targets', None) or []
+        self.targets_file = self.config.get('targets_file', None)
+        self.target_workers = self.config.get('target_workers', 8)
+        self.target_name = config.get('target_name', None)
+        self.docker_source = 'cadvisor' if self.target_name else self.config.get('docker_source', 'socket')
+
+        # running containers are tracked from the docker events stream rather than listed every run
+        self.docker_inventory = None
+        if self.docker_enabled and self.docker_source == 'socket' and self.config.get('docker_events', True):
+            self.docker_inventory = DockerInventory(self.docker_socket,
+                                                    self.config.get('docker_resync_interval', 300),
+                                                    self.log_error,
+                                                    self.log_info)
+
+        # a cadvisor endpoint resolved from docker (host docker/<name>) is kept until a connection to it
+        # fails or docker reports an event for the cadvisor container. failed re-resolutions keep the
+        # last endpoint and are retried with an exponential back-off
+        self.cadvisor_container_id = None
+        self.cadvisor_endpoint_stale = False
+        self.cadvisor_resolve_backoff = 0
+        self.cadvisor_resolve_retry = 0
+        if self.docker_inventory is not None:
+            self.docker_inventory.add_listener(self.cadvisor_container_event)
+
+        # transient failures (timeouts, refused connections, docker errors) skip the interval (TransientError)
+        # instead of stopping the plugin. failed connections are retried (with jitter) within the interval,
+        # after circuit_threshold failed intervals cadvisor is left alone for circuit_reset seconds (doubling
+        # while it keeps failing) and a failing docker listing falls back on the last good container list
+        self.retry_attempts = self.config.get('retry_attempts', 3)
+        self.retry_delay = self.config.get('retry_delay', 0.2)
+        self.circuit = CircuitBreaker(self.config.get('circuit_threshold', 3), self.config.get('circuit_reset', 30))
+        self.docker_container_listed = False
+
     def log(self, message, level='INFO'):
         """
         log a message to stdout 'INFO' or stderr 'ERR'
@@ -138,12 +355,193 @@ class CAdvisor(object):
         """
         pass
 
+    def dispatch_batch(self, container_name, container_id, records):
+        """
+        send a container's records to the target output, calling dispatch_metric() for each
+        records are (plugin, plugin_instance, type, type_instance, values, cumulative) tuples
+        intended to be overridden by backends which can output a whole batch more efficiently
+        """
+        dispatch_metric = self.dispatch_metric
+        for plugin, plugin_instance, metric_type, type_instance, metric_value, cumulative in records:
+            dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, metric_value)
+
     def gen_host_name(self, hostname, container_name, container_id):
         return(self.host_namespec.format(hn=hostname, cn=container_name, cid=container_id))
 
     def gen_plugin_name(self, hostname, container_name, container_id, plugin):
         return('{}{}'.format(self.plugin_namespec.format(hn=hostname, cn=container_name, cid=container_id), plugin))
 
+    def gen_series_name(self, container_name, container_id, plugin, plugin_instance, metric_type, type_instance):
+        """
+        the name a backend needs to dispatch a series, called once per series by series_name()
+        intended to be overridden by backends which can precompute more of their output
+        """
+        return(self.gen_plugin_name(None, container_name, container_id, plugin))
+
+    def series_name(self, container_name, container_id, plugin, plugin_instance, metric_type, type_instance):
+        """ gen_series_name(), cached for as long as the container keeps being output """
+        container_key = (container_name, container_id)
+        series_key = (plugin, plugin_instance, metric_type, type_instance)
+        try:
+            return(self.series_names[container_key][series_key])
+        except KeyError:
+            name = self.gen_series_name(container_name, container_id, plugin, plugin_instance, metric_type, type_instance)
+            self.series_names.setdefault(container_key, {})[series_key] = name
+            return(name)
+
+    def instance_name(self, fmt, *args):
+        """ fmt.format(*args), cached """
+        key = (fmt, args)
+        try:
+            return(self.instance_names[key])
+        except KeyError:
+            name = self.instance_names[key] = fmt.format(*args)
+            return(name)
+
+    def evict_container(self, container_key):
+        """
+        forget everything cached for a (container name, container id)
+        backends with their own per container caches extend this
+        """
+        self.series_names.pop(container_key, None)
+        self.sample_times.pop(container_key, None)
+        self.dispatch_times.pop(container_key, None)
+        if self.change_filter is not None:
+            self.change_filter.evict(container_key)
+        if self.rate_engine is not None:
+            self.rate_engine.evict(container_key)
+        if self.per_cpu_rates is not None:
+            self.per_cpu_rates.evict(container_key)
+        self.container_ranks.pop(container_key, None)
+        if self.other_rates is not None:
+            self.other_rates.evict(container_key)
+
+    def evict_containers(self):
+        """ evict the cached names (and rate state) of containers which were not output this run """
+        cached = set(self.series_names)
+        cached.update(self.sample_times)
+        cached.update(self.dispatch_times)
+        if self.change_filter is not None:
+            cached.update(self.change_filter.state)
+        if self.rate_engine is not None:
+            cached.update(self.rate_engine.state)
+        if self.per_cpu_rates is not None:
+            cached.update(self.per_cpu_rates.state)
+        cached.update(self.container_ranks)
+        if self.other_rates is not None:
+            cached.update(self.other_rates.state)
+        for container_key in cached - self.containers_seen:
+            self.evict_container(container_key)
+        self.containers_seen = set()
+
+    def parse_timestamp(self, timestamp):
+        """
+        RFC 3339 timestamp as returned by cadvisor (e.g. 2015-06-18T19:45:36.123456789Z or ...-07:00) to epoch seconds
+        the epoch of each minute (with its zone offset applied) is computed once and cached, only the
+        seconds are parsed per sample
+        """
+        if timestamp[-1] in 'Zz':
+            zone = 'Z'
+            end = -1
+        elif timestamp[-6:-5] in ('+', '-'):
+            zone = timestamp[-6:]
+            end = -6
+        else:
+            zone = ''
+            end = len(timestamp)
+        minute = timestamp[0:16] + zone
+        base = self.timestamp_cache.get(minute, None)
+        if base is None:
+            base = calendar.timegm(time.strptime(timestamp[0:16], '%Y-%m-%dT%H:%M'))
+            if zone not in ('', 'Z'):
+                offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+                base += -offset if zone[0] == '+' else offset
+            if len(self.timestamp_cache) > 1000:
+                self.timestamp_cache.clear()
+            self.timestamp_cache[minute] = base
+        return(base + float(timestamp[17:end]))
+
+    def dispatch_records(self, container_name, container_id, records):
+        """
+        minus the series already dispatched with a time at or past dispatch_time, cumulative counters as-is
+        and/or as per second rates (rates configuration), minus the values which have not changed enough
+        to be sent (change-only emission), then the batch goes to dispatch_batch()
+        """
+        container_key = (container_name, container_id)
+        dispatch_time = self.dispatch_time
+        if dispatch_time is not None:
+            last_times = self.dispatch_times.get(container_key, None)
+            if last_times is None:
+                last_times = self.dispatch_times[container_key] = {}
+            fresh = []
+            for record in records:
+                series_key = record[0:4]
+                if last_times.get(series_key, 0) >= dispatch_time:
+                    continue
+                last_times[series_key] = dispatch_time
+                fresh.append(record)
+            records = fresh
+
+        if self.rate_engine is not None:
+            rate = self.rate_engine.rate
+            rate_plugins = self.rate_plugins
+            keep_raw = self.rate_mode == 'both'
+            sample_time = self.sample_time
+            output = []
+            for record in records:
+                if not record[5] or record[0] not in rate_plugins:
+                    output.append(record)
+                    continue
+                if keep_raw:
+                    output.append(record)
+                values = rate(container_key, record[0:4], sample_time, record[4])
+                if values is not None:
+                    output.append((record[0], record[1], self.instance_name('{}_rate', record[2]), record[3], values, False))
+            records = output
+
+        if self.change_filter is not None:
+            changed = self.change_filter.changed
+            records = [record for record in records if changed(container_key, record[0:4], record[4])]
+
+        if records:
+            self.values_dispatched += len(records)
+            self.dispatch_batch(container_name, container_id, records)
+
+    def dispatch_collector_metrics(self, records):
+        """ dispatch the plugin's own metrics, (type, type_instance, value), stamped with the current time (not the last sample's) """
+        self.containers_seen.add(self.COLLECTOR)
+        self.dispatch_time = None
+        self.dispatch_batch(self.COLLECTOR[0], self.COLLECTOR[1],
+                            [(self.COLLECTOR_PLUGIN, None, metric_type, type_instance, [value], False) for metric_type, type_instance, value in records])
+
+    def emit_collector_metrics(self):
+        """ the cost of the last fetch and emit, stream mode has no separate fetch and parse times (they happen during emit) """
+        stats = self.collector_stats
+        records = []
+        for key in ('fetch', 'parse', 'docker', 'emit'):
+            if key in stats:
+                records.append(('duration', key, stats[key]))
+        for key in ('bytes',):
+            if key in stats:
+                records.append(('bytes', key, stats[key]))
+        for key in ('requests', 'cgroups_seen', 'cgroups_emitted', 'values', 'containers_suppressed', 'series_suppressed'):
+            if key in stats:
+                records.append(('count', key, stats[key]))
+        self.dispatch_collector_metrics(records)
+
+    def emit_read_metrics(self, read_time, prefetcher=None, writer=None):
+        """ the duration of the read callback and the (cumulative) connection pool, prefetch and output counters """
+        records = [('duration', 'read', read_time)]
+        for key, value in self.http_pool.stats().iteritems():
+            records.append(('derive', self.instance_name('pool_{}', key), value))
+        if prefetcher is not None:
+            for key, value in prefetcher.counters.items():
+                records.append(('derive', self.instance_name('prefetch_{}', key), value))
+        if writer is not None:
+            for key, value in writer.counters.items():
+                records.append(('derive', self.instance_name('output_{}', key), value))
+        self.dispatch_collector_metrics(records)
+
     def is_container_id(self, id):
         """
         basically, is 'id' a hex string...
@@ -172,24 +570,70 @@ class CAdvisor(object):
                 return True
         return False
 
+    def container_selected(self, container):
+        """ is the container listed in docker_containers (by name or id prefix) """
+        if self.container_match_all:
+            return(True)
+        for name in container['Names']:
+            if name in self.container_match_names:
+                return(True)
+        container_id = container['Id']
+        for length, prefixes in self.container_match_ids.iteritems():
+            if container_id[0:length] in prefixes:
+                return(True)
+        return(False)
+
     def set_container_slice_ids(self):
         """
         adds a 'SliceId' key to each of the containers
         initially sets it to None
         uses docker_container_config to determine which containers to set the SliceId
+        indexes the selected containers by id, only when the container list has changed since the last run
         """
-        docker_container_config = self.docker_container_config
-        all_containers = '*' in docker_container_config
-        for container_idx, container in enumerate(self.docker_container_list):
-            self.docker_container_list[container_idx]['SliceId'] = None
-            slice_id = "/system.slice/docker-{cid}.scope".format(cid=container['Id'])
-            if all_containers:
-                self.docker_container_list[container_idx]['SliceId'] = slice_id
-            else:
-                for include_container in docker_container_config:
-                    if self.container_match(include_container, container['Id'], container['Names']):
-                        self.docker_container_list[container_idx]['SliceId'] = slice_id
-                        break  # not supporting substrings, explicit container name/id only
+        if self.container_index is not None:
+            return
+
+        container_index = {}
+        for container in self.docker_container_list:
+            container['SliceId'] = None
+            if self.container_selected(container):
+                container['SliceId'] = "/system.slice/docker-{cid}.scope".format(cid=container['Id'])
+                container['MetricName'] = ''.join(container['Names']).replace('/', '')
+                container_index[container['Id']] = container
+
+        self.container_index = container_index
+        if len(self.cgroup_container_ids) > 4 * len(self.docker_container_list) + 1024:
+            self.cgroup_container_ids = {}
+
+    def cgroup_container_id(self, cgroup):
+        """ the docker container id embedded in a cgroup path (e.g. /system.slice/docker-<id>.scope, /docker/<id>), or None """
+        try:
+            return(self.cgroup_container_ids[cgroup])
+        except KeyError:
+            match = self.container_id_re.search(cgroup)
+            container_id = match.group(0) if match else None
+            self.cgroup_container_ids[cgroup] = container_id
+            return(container_id)
+
+    def cadvisor_container_event(self, status, container_id):
+        """ docker inventory listener (events thread), the cadvisor container changed, resolve it again """
+        if container_id == self.cadvisor_container_id:
+            self.cadvisor_endpoint_stale = True
+            self.cadvisor_resolve_retry = 0
+
+    def cadvisor_connection_failed(self):
+        """ the cadvisor endpoint did not answer, resolve it again before the next fetch (docker/<name> hosts) """
+        self.cadvisor_endpoint_stale = True
+        self.circuit.failure()
+
+    def cadvisor_resolve_failed(self):
+        """ keep the last resolved endpoint and retry later, without one there is nothing to fall back on """
+        if not (self.host and self.port):
+            raise TransientError('Unable to resolve cadvisor endpoint "{}"'.format(self.config_host))
+        self.cadvisor_resolve_backoff = min(max(1, self.cadvisor_resolve_backoff * 2), 300)
+        self.cadvisor_resolve_retry = time.time() + self.cadvisor_resolve_backoff
+        self.log_warning('Keeping cadvisor endpoint {}:{}, resolving again in {}s'.format(self.host, self.port, self.cadvisor_resolve_backoff))
+        return(True)
 
     def set_cadvisor_connect_info(self):
         """
@@ -198,18 +642,24 @@ class CAdvisor(object):
         #
         # return if host and port are already set
         # and were defined statically in the collectd config
+        # or were resolved from docker and nothing suggests they have changed
         #
         host_spec = self.config_host
         port_spec = self.config_port
         docker_prefix = 'docker/'
-        if self.host and self.port and not host_spec.lower().startswith(docker_prefix):
-            return True
+        if self.host and self.port:
+            if not host_spec.lower().startswith(docker_prefix):
+                return True
+            if not self.cadvisor_endpoint_stale or time.time() < self.cadvisor_resolve_retry:
+                return True
 
         ip = None
         port = port_spec
 
         if re.match('^\d{1,3}(\.\d{1,3}){3}$', host_spec):
             ip = host_spec
+        elif self.target_name and re.match('^[A-Za-z0-9]([A-Za-z0-9.-]*[A-Za-z0-9])?$', host_spec):    # remote target, may be a dns name
+            ip = host_spec
         elif host_spec.lower().startswith(docker_prefix):               # cadvisor_connect is a docker container specifier
             container_identifier = host_spec[len(docker_prefix):]
             cadvisor_container = None
@@ -218,7 +668,8 @@ class CAdvisor(object):
                 cadvisor_container = cli.inspect_container(container_identifier)
                 if not cadvisor_container['State']['Running']:
                     self.log_error('Error specified CAdvisor container "{}" is not running.'.format(host_spec))
-                    sys.exit(1)
+                    return(self.cadvisor_resolve_failed())
+                self.cadvisor_container_id = cadvisor_container['Id']
                 ip = cadvisor_container['NetworkSettings']['IPAddress']
                 for exposed_port in cadvisor_container['Config']['ExposedPorts']:
                     if '/tcp' in exposed_port:
@@ -226,46 +677,103 @@ class CAdvisor(object):
                         break
             except docker.errors.APIError, e:
                 self.log_error('Error retrieving container from docker: {}'.format(e))
-                sys.exit(1)
+                return(self.cadvisor_resolve_failed())
             except IOError, e:
                 self.log_error('Error connecting to docker socket "{}": {}'.format(self.docker_socket, e))
-                sys.exit(1)
+                return(self.cadvisor_resolve_failed())
         else:
             self.log_error('Invalid cadvisor connection method specified "{}".'.format(host_spec))
             sys.exit(2)
 
         connection_specifier = '{}:{}'.format(ip, port)
-        if not re.match('^\d{1,3}(\.\d{1,3}){3}:\d+$', connection_specifier):
+        if not re.match('^\d{1,3}(\.\d{1,3}){3}:\d+$', connection_specifier) and not (self.target_name and re.match('^[A-Za-z0-9.-]+:\d+$', connection_specifier)):
             self.log_error('No valid connection specifier found for cadvisor "{}" = "{}".'.format(host_spec, connection_specifier))
             sys.exit(2)
 
         self.host = ip
         self.port = port
+        self.cadvisor_endpoint_stale = False
+        self.cadvisor_resolve_backoff = 0
+        return(True)
+
+    def keep_container_list(self, message):
+        """ the container list could not be refreshed, carry on with the last good one (if there is one) """
+        if not self.docker_container_listed:
+            raise TransientError(message)
+        self.log_warning('{}, using the last known container list'.format(message))
         return(True)
 
     def set_docker_container_list(self):
         """
         get list of containers from docker socket using docker api
+        (or from the event driven inventory, docker is then only contacted for the initial sync)
         add a SliceId element (to hold the cadvisor slice id)
         """
 
+        if self.docker_source == 'cadvisor':
+            try:
+                self.docker_container_list = self.get_cadvisor_container_list()
+            except TransientError, e:
+                if not self.docker_container_listed:
+                    # otherwise counted by the stats fetch which follows
+                    self.circuit.failure()
+                return(self.keep_container_list(str(e)))
+            self.docker_container_listed = True
+            self.container_index = None
+            return(True)
+
         try:
+            if self.docker_inventory is not None:
+                if not self.docker_inventory.started():
+                    self.docker_inventory.start()
+                version = self.docker_inventory.version
+                if version != self.docker_inventory_version:
+                    self.docker_container_list = self.docker_inventory.containers()
+                    self.docker_inventory_version = version
+                    self.docker_container_listed = True
+                    self.container_index = None
+                return(True)
+
             cli = docker.Client(base_url='unix:/{}'.format(self.docker_socket))
             #
             # fragile: docker-py defaults to only listing 'running' containers
             # call explicitly with all=False in case default behavior changes
             # TODO check the docker-py code for this API call to ensure all=False does force only running
             #
-            self.docker_container_list = cli.containers(all=False)
+            self.docker_container_list = retry(lambda: cli.containers(all=False), self.retry_attempts, self.retry_delay,
+                                               retry_on=(docker.errors.APIError, IOError), log=self.log_warning)
+            self.docker_container_listed = True
+            self.container_index = None
         except docker.errors.APIError, e:
-            self.log_error('Error retrieving from docker: {}'.format(e))
-            sys.exit(1)
+            return(self.keep_container_list('Error retrieving from docker: {}'.format(e)))
         except IOError, e:
-            self.log_error('Error connecting to docker socket "{}": {}'.format(self.docker_socket, e))
-            sys.exit(1)
+            return(self.keep_container_list('Error connecting to docker socket "{}": {}'.format(self.docker_socket, e)))
 
         return(True)
 
+    def get_cadvisor_container_list(self):
+        """
+        the running docker containers as known to cadvisor, in the same form as docker-py's containers() (Id, Names)
+        used for remote targets, where the docker socket is not available
+        """
+        url = 'http://{}:{}/api/v2.0/spec?recursive=true'.format(self.host, self.port)
+        try:
+            specs = json.loads(self.fetch_path('/api/v2.0/spec?recursive=true'))
+        except (IOError, ValueError), e:
+            raise TransientError('Error retrieving container list from "{}": {}'.format(url, e))
+
+        containers = []
+        for cgroup, spec in specs.iteritems():
+            if spec.get('namespace', None) != 'docker':
+                continue
+            match = self.container_id_re.search(cgroup)
+            if not match:
+                continue
+            container_id = match.group(0)
+            names = ['/' + alias for alias in spec.get('aliases', []) if alias != container_id]
+            containers.append({'Id': container_id, 'Names': names})
+        return(containers)
+
     def get_active_metrics(self):
         """
         locate the various metric groups in the configuration (keys starting with 'metrics_')
@@ -282,30 +790,232 @@ class CAdvisor(object):
                     active_metrics[k[len(key_prefix):]] = v
         return(active_metrics)
 
+    def get_metric_plan(self):
+        """
+        compile the active metric groups into the set of fields each emit_<group>_metrics method will output
+        'all' selects every field of the group, unknown fields are ignored (with a warning)
+        """
+        metric_plan = {}
+        for group, selectors in self.active_metrics.iteritems():
+            fields = self.METRIC_FIELDS.get(group, None)
+            if fields is None:
+                self.log_warning('Unknown metric group "metrics_{}" ignored. See documentation: {}'.format(group, self.doc_url))
+                continue
+            aliases = self.METRIC_FIELD_ALIASES.get(group, {})
+            selected = set()
+            for selector in map(str.lower, selectors):
+                if selector == 'all':
+                    selected.update(fields)
+                elif selector in fields:
+                    selected.add(selector)
+                elif selector in aliases:
+                    selected.update(aliases[selector])
+                else:
+                    self.log_warning('Unknown metric "{}" in metrics_{} ignored. See documentation: {}'.format(selector, group, self.doc_url))
+            metric_plan[group] = frozenset(selected)
+        return(metric_plan)
+
+    def service_tree_required(self):
+        """ True if the system services configuration can select cgroups which are only found by walking the whole tree """
+        options = self.system_services['options']
+        if any(options[option] for option in options):
+            return(True)
+        if self.service_filter in ('all', 'exclude'):
+            return(True)
+        return(len([elem for elem in self.system_services['include'] if elem != '*']) > 0)
+
+    def plan_fetch(self):
+        """
+        decide which cadvisor requests to make this interval, returns (plan, [url paths])
+
+        recursive: one request for the entire cgroup tree
+        targeted:  '/' (if system metrics are enabled) plus one request per monitored docker container,
+                   only possible when no system services are to be emitted
+
+        in 'auto' mode the plan with the lower measured cost is used, the other plan is re-measured
+        every fetch_probe_interval runs so the choice follows changes in the number of containers.
+        """
+        recursive = ('recursive', ['/api/v2.0/stats?recursive=true&count={}'.format(self.fetch_count)])
+        if self.fetch_mode == 'recursive' or self.service_tree_required():
+            return(recursive)
+
+        paths = []
+        if self.system_enabled:
+            paths.append('/api/v2.0/stats?count={}'.format(self.fetch_count))
+        for container_id in self.container_index or {}:
+            paths.append('/api/v2.0/stats/{}?type=docker&count={}'.format(container_id, self.fetch_count))
+        targeted = ('targeted', paths)
+        if self.fetch_mode == 'targeted':
+            return(targeted)
+
+        self.fetch_runs += 1
+        recursive_cost = self.fetch_cost.get('recursive', None)
+        request_cost = self.fetch_cost.get('targeted', None)
+        if recursive_cost is None:
+            return(recursive)
+        if request_cost is None:
+            return(targeted)
+
+        cheaper, other = (targeted, recursive) if request_cost * len(paths) < recursive_cost else (recursive, targeted)
+        if self.fetch_runs % self.fetch_probe_interval == 0:
+            return(other)
+        return(cheaper)
+
+    def record_fetch_cost(self, plan, requests, elapsed):
+        """ keep a moving average of the cost of each plan, per request for targeted fetches """
+        if not requests:
+            return
+        cost = elapsed / requests if plan == 'targeted' else elapsed
+        previous = self.fetch_cost.get(plan, None)
+        self.fetch_cost[plan] = cost if previous is None else previous * 0.7 + cost * 0.3
+
+    def set_fetch_count(self):
+        """
+        number of samples to request per cgroup, 1 unless backfill is enabled and the time since the
+        previous fetch is well over the usual read interval
+        """
+        now = time.time()
+        self.fetch_count = 1
+        if self.backfill and self.last_fetch is not None:
+            gap = now - self.last_fetch
+            if self.read_interval is None:
+                self.read_interval = gap
+            elif gap > 1.5 * self.read_interval:
+                samples = int(math.ceil(gap / self.housekeeping_interval)) + 1
+                self.fetch_count = min(self.backfill_max_samples, samples)
+            else:
+                self.read_interval = self.read_interval * 0.8 + gap * 0.2
+        self.last_fetch = now
+
+    def fetch_path(self, path, timeout=5):
+        """ GET path from cadvisor, failed connections are retried, http errors and timeouts are not """
+        return(retry(lambda: self.http_pool.fetch(self.host, self.port, path, timeout), self.retry_attempts, self.retry_delay,
+                     retry_on=(IOError,), give_up_on=(urllib2.HTTPError, socket.timeout), log=self.log_warning))
+
     def fetch_metrics(self):
-        """fetch stats from CAdvisor, parse returned JSON, return a python data structure"""
+        """
+        fetch stats from CAdvisor, parse returned JSON, return a python data structure
+        in streaming mode, return a generator of (cgroup, stats) pairs parsed as the responses arrive
+        raises TransientError when the interval has to be skipped
+        """
         #
         # dynamic items needed for each fetch run.
         #   cadvisor connection information
+        #   list of running containers from docker
+        #   slice ids for running containers
         #
+        # a new dict each run, the previous one may still be read by emit_collector_metrics (prefetch)
+        collector_stats = self.collector_stats = {'bytes': 0, 'requests': 0}
+        # a stream cut short leaves fetch_complete False, the cgroups not reached are not evicted
+        self.fetch_complete = True
+
+        if not self.circuit.allow():
+            raise TransientError('CAdvisor {}:{} keeps failing, not contacted for now'.format(self.host, self.port))
+
         self.set_cadvisor_connect_info()
+        if self.docker_enabled:
+            start = time.time()
+            self.set_docker_container_list()
+            collector_stats['docker'] = time.time() - start
+            self.set_container_slice_ids()
+
+        self.set_fetch_count()
+        plan, paths = self.plan_fetch()
+        if self.stream_stats:
+            return(self.stream_metrics(plan, paths))
 
-        url = "http://{}:{}/api/v2.0/stats?recursive=true&count=1".format(self.host, self.port)
         stats = {}
-        try:
-            response = urllib2.urlopen(url, None, 5)
-            stats = json.loads(response.read())
-        except urllib2.URLError, e:
-            if hasattr(e, 'reason'):
-                self.log_error("Failed to reach server, reason {}".format(e.reason))
-            elif hasattr(e, 'code'):
-                self.log_error("Server unable to fulfill request {}".format(e.code))
-            sys.exit(1)
-        except socket.timeout:
-            self.log_error("Timeout connecting to {}".format(url))
-            sys.exit(1)
+        start = time.time()
+        fetch_time = 0.0
+        parse_time = 0.0
+        for path in paths:
+            url = 'http://{}:{}{}'.format(self.host, self.port, path)
+            try:
+                request_start = time.time()
+                body = self.fetch_path(path)
+                fetched = time.time()
+                stats.update(json.loads(body))
+                fetch_time += fetched - request_start
+                parse_time += time.time() - fetched
+                collector_stats['bytes'] += len(body)
+                collector_stats['requests'] += 1
+                body = None
+            except urllib2.HTTPError, e:
+                if '?type=docker' in path:
+                    # the container most likely exited since the container list was retrieved
+                    self.log_warning('Unable to retrieve "{}": {}'.format(url, e))
+                    continue
+                self.circuit.failure()
+                raise TransientError("Server unable to fulfill request {}".format(e.code))
+            except urllib2.URLError, e:
+                self.cadvisor_connection_failed()
+                raise TransientError("Failed to reach server, reason {}".format(e.reason))
+            except socket.timeout:
+                self.cadvisor_connection_failed()
+                raise TransientError("Timeout connecting to {}".format(url))
+            except ValueError, e:
+                self.circuit.failure()
+                raise TransientError('Invalid response from "{}": {}'.format(url, e))
+        self.circuit.success()
+        self.record_fetch_cost(plan, len(paths), time.time() - start)
+        collector_stats['fetch'] = fetch_time
+        collector_stats['parse'] = parse_time
         return(stats)
 
+    def prefetch_metrics(self):
+        """ fetch_metrics, with a streamed response read completely so the snapshot can be handed to another thread """
+        metrics = self.fetch_metrics()
+        if not isinstance(metrics, dict):
+            metrics = list(metrics)
+        return(metrics)
+
+    def stream_metrics(self, plan, paths):
+        """
+        generator, yields (cgroup, stats) from each of the cadvisor responses as each cgroup is parsed
+        a failure ends the stream (counted by the circuit breaker, like a failed fetch), cgroups already yielded stand
+        """
+        start = time.time()
+        collector_stats = self.collector_stats
+        failed = False
+        for path in paths:
+            url = 'http://{}:{}{}'.format(self.host, self.port, path)
+            response = None
+            try:
+                response = self.http_pool.urlopen(self.host, self.port, path, 5)
+                collector_stats['requests'] += 1
+                for service, stats in iter_object_items(response):
+                    yield service, stats
+            except urllib2.HTTPError, e:
+                if '?type=docker' in path:
+                    # the container most likely exited since the container list was retrieved
+                    self.log_warning('Unable to retrieve "{}": {}'.format(url, e))
+                else:
+                    self.log_error('Unable to retrieve "{}": {}'.format(url, e))
+                    self.circuit.failure()
+                    failed = True
+            except urllib2.URLError, e:
+                self.log_error('Unable to retrieve "{}": {}'.format(url, e))
+                self.cadvisor_connection_failed()
+                failed = True
+            except socket.timeout:
+                self.log_error("Timeout reading from {}".format(url))
+                self.cadvisor_connection_failed()
+                failed = True
+            except (socket.error, ValueError), e:
+                self.log_error("Error reading stats from {}: {}".format(url, e))
+                self.circuit.failure()
+                failed = True
+            finally:
+                if response is not None:
+                    collector_stats['bytes'] += response.bytes_read
+                    response.close()
+            if failed:
+                self.fetch_complete = False
+                break
+        else:
+            self.circuit.success()
+        self.record_fetch_cost(plan, len(paths), time.time() - start)
+
     #
     # Collectd is particular about the way it wants metric names formatted.
     # The naming schema is documented here: https://collectd.org/wiki/index.php/Naming_schema
@@ -318,55 +1028,69 @@ class CAdvisor(object):
     #   3 the 'type's used are a combination of the types in the collectd default types.db and custom types in cadvisor-types.db
     #
 
-    def emit_cpu_metrics(self, container_name, container_id, metrics):
-        """ parse cpu metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; output metric """
+    def emit_cpu_metrics(self, metrics):
+        """ parse cpu metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; yield records """
 
         plugin = 'cpu'
+        fields = self.metric_plan['cpu']
 
-        plugin_instance = None
-        metric_type = 'gauge'
-        type_instance = 'avg'
-        self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [metrics['load_average']])
+        if 'load_average' in fields:
+            plugin_instance = None
+            metric_type = 'gauge'
+            type_instance = 'avg'
+            yield plugin, plugin_instance, metric_type, type_instance, [metrics['load_average']], False
 
         plugin_instance = None
         metric_type = 'time_ns'
         for key in ('system', 'total', 'user'):
-            type_instance = key
-            self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [metrics['usage'][key]])
-
-        metric_type = 'time_ns'
-        type_instance = None
-        for i, v in enumerate(metrics['usage']['per_cpu_usage']):
-            plugin_instance = str(i)
-            self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [v])
-
-    def emit_memory_metrics(self, container_name, container_id, metrics):
-        """ parse memory metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; output metric """
+            if key in fields:
+                type_instance = key
+                yield plugin, plugin_instance, metric_type, type_instance, [metrics['usage'][key]], True
+
+        if 'per_cpu_usage' in fields:
+            per_cpu_usage = metrics['usage']['per_cpu_usage']
+            if self.per_cpu_mode != 'aggregate':
+                metric_type = 'time_ns'
+                type_instance = None
+                for i, v in enumerate(per_cpu_usage):
+                    plugin_instance = self.instance_name('{}', i)
+                    yield plugin, plugin_instance, metric_type, type_instance, [v], True
+
+            if self.per_cpu_rates is not None and per_cpu_usage:
+                rates = self.per_cpu_rates.rates(self.container_key, self.sample_time, per_cpu_usage)
+                if rates is not None:
+                    plugin_instance = self.PER_CPU_AGGREGATE
+                    metric_type = 'time_ns_rate'
+                    for type_instance, value in zip(AGGREGATES, summarize(rates)):
+                        yield plugin, plugin_instance, metric_type, type_instance, [value], False
+
+    def emit_memory_metrics(self, metrics):
+        """ parse memory metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; yield records """
 
         plugin = 'memory'
+        fields = self.metric_plan['memory']
 
         plugin_instance = None
         metric_type = 'memory'
-        type_instance = 'usage'
-        self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [metrics['usage']])
-
-        plugin_instance = None
-        metric_type = 'memory'
-        type_instance = 'working_set'
-        self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [metrics['working_set']])
+        for key in ('usage', 'working_set'):
+            if key in fields:
+                type_instance = key
+                yield plugin, plugin_instance, metric_type, type_instance, [metrics[key]], False
 
         plugin_instance = None
         metric_type = 'gauge'
         type_instance = None
         for item in ('hierarchical', 'container'):
-            item_key = '{}_data'.format(item)
+            item_key = self.instance_name('{}_data', item)
+            if item_key not in fields:
+                continue
             plugin_instance = item_key
             for key in metrics[item_key]:
                 type_instance = key
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [metrics[item_key][key]])
+                yield plugin, plugin_instance, metric_type, type_instance, [metrics[item_key][key]], False
 
-    def emit_network_metrics(self, container_name, container_id, metrics):
-        """ parse network metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; output metric """
+    def emit_network_metrics(self, metrics):
+        """ parse network metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; yield records """
 
         plugin = 'net'
 
@@ -382,18 +1106,42 @@ class CAdvisor(object):
         # the if_(dropped|packets|octets|errors) collectd types
         # expect the values to be compound in the form: rx:tx
         #
+        fields = self.metric_plan['network']
+        items = [item for item in ('dropped', 'packets', 'bytes', 'errors') if item in fields]
         for i, v in enumerate(metrics):
-            plugin_instance = 'if{}'.format(i)
-            for item in ('dropped', 'packets', 'bytes', 'errors'):
-                rx_key = 'rx_{}'.format(item)
-                tx_key = 'tx_{}'.format(item)
-                metric_type = 'if_{}'.format('octets' if item == 'bytes' else item)
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [v[rx_key], v[tx_key]])
+            plugin_instance = self.instance_name('if{}', i)
+            for item in items:
+                rx_key = self.instance_name('rx_{}', item)
+                tx_key = self.instance_name('tx_{}', item)
+                metric_type = self.instance_name('if_{}', 'octets' if item == 'bytes' else item)
+                yield plugin, plugin_instance, metric_type, type_instance, [v[rx_key], v[tx_key]], True
+
+    def emit_diskio_metrics(self, metrics):
+        """ diskio records per device, totalled across the devices, or both (diskio_mode) """
+        records = self.emit_diskio_device_metrics(metrics)
+        if self.diskio_mode == 'series':
+            return(records)
+
+        # one pass, totals keyed by (type, type_instance, cumulative) in the order first seen
+        records = list(records)
+        totals = {}
+        order = []
+        for plugin, plugin_instance, metric_type, type_instance, metric_value, cumulative in records:
+            key = (metric_type, type_instance, cumulative)
+            if key not in totals:
+                totals[key] = metric_value[0]
+                order.append(key)
+            else:
+                totals[key] += metric_value[0]
+        total_records = [('blkio', 'total', metric_type, type_instance, [totals[(metric_type, type_instance, cumulative)]], cumulative)
+                         for metric_type, type_instance, cumulative in order]
+        return(total_records if self.diskio_mode == 'total' else records + total_records)
 
-    def emit_diskio_metrics(self, container_name, container_id, metrics):
-        """ parse diskio metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; output metric """
+    def emit_diskio_device_metrics(self, metrics):
+        """ parse diskio metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; yield records """
 
         plugin = 'blkio'
+        fields = self.metric_plan['diskio']
 
         #
         # see: https://www.kernel.org/doc/Documentation/cgroups/blkio-controller.txt
@@ -407,73 +1155,76 @@ class CAdvisor(object):
         # times
         #
         metric = 'io_time'
-        if metric in metrics:
+        if metric in metrics and metric in fields:
             metric_type = 'time_ms'
             type_instance = metric
             for device in metrics[metric]:
-                plugin_instance = '{}_{}'.format(device['major'], device['minor'])
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['stats']['Count']])
+                plugin_instance = self.instance_name('{}_{}', device['major'], device['minor'])
+                yield plugin, plugin_instance, metric_type, type_instance, [device['stats']['Count']], True
 
         metric_type = 'time_ns'
         for metric in ('io_wait_time', 'io_service_time'):
-            if metric in metrics:
+            if metric in metrics and metric in fields:
                 for device in metrics[metric]:
-                    plugin_instance = '{}_{}'.format(device['major'], device['minor'])
+                    plugin_instance = self.instance_name('{}_{}', device['major'], device['minor'])
                     for stat in device['stats']:
-                        type_instance = '{}_{}'.format(metric, stat)
-                        self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]])
+                        type_instance = self.instance_name('{}_{}', metric, stat)
+                        yield plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]], True
 
         # bytes
         metric = 'io_service_bytes'
         metric_type = 'bytes'
-        if metric in metrics:
+        if metric in metrics and metric in fields:
             for device in metrics[metric]:
-                plugin_instance = '{}_{}'.format(device['major'], device['minor'])
+                plugin_instance = self.instance_name('{}_{}', device['major'], device['minor'])
                 for stat in device['stats']:
-                    type_instance = '{}_{}'.format(metric, stat)
-                    self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]])
+                    type_instance = self.instance_name('{}_{}', metric, stat)
+                    yield plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]], True
 
         # gauges/counters
         metric = 'sectors'
         metric_type = 'gauge'
-        if metric in metrics:
-            type_instance = '{}'.format(metric)
+        if metric in metrics and metric in fields:
+            type_instance = metric
             for device in metrics[metric]:
-                plugin_instance = '{}_{}'.format(device['major'], device['minor'])
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['stats']['Count']])
+                plugin_instance = self.instance_name('{}_{}', device['major'], device['minor'])
+                yield plugin, plugin_instance, metric_type, type_instance, [device['stats']['Count']], True
 
         metric_type = 'gauge'
         for metric in ('io_serviced', 'io_merged'):
-            if metric in metrics:
+            if metric in metrics and metric in fields:
                 for device in metrics[metric]:
-                    plugin_instance = '{}_{}'.format(device['major'], device['minor'])
+                    plugin_instance = self.instance_name('{}_{}', device['major'], device['minor'])
                     for stat in device['stats']:
-                        type_instance = '{}_{}'.format(metric, stat)
-                        self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]])
+                        type_instance = self.instance_name('{}_{}', metric, stat)
+                        yield plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]], True
 
         metric = 'io_queued'
         metric_type = 'counter'
-        if metric in metrics:
+        if metric in metrics and metric in fields:
             for device in metrics[metric]:
-                plugin_instance = '{}_{}'.format(device['major'], device['minor'])
+                plugin_instance = self.instance_name('{}_{}', device['major'], device['minor'])
                 for stat in device['stats']:
-                    type_instance = '{}_{}'.format(metric, stat)
-                    self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]])
+                    type_instance = self.instance_name('{}_{}', metric, stat)
+                    yield plugin, plugin_instance, metric_type, type_instance, [device['stats'][stat]], False
 
-    def emit_load_metrics(self, container_name, container_id, metrics):
-        """ parse load metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; output metric """
+    def emit_load_metrics(self, metrics):
+        """ parse load metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; yield records """
 
         plugin = 'load_stats'
         plugin_instance = None
         metric_type = 'gauge'
         type_instance = None
 
+        fields = self.metric_plan['load_stats']
         for metric in metrics:
-            type_instance = '-{}'.format(metric)
-            self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [metrics[metric]])
+            if metric not in fields:
+                continue
+            type_instance = self.instance_name('-{}', metric)
+            yield plugin, plugin_instance, metric_type, type_instance, [metrics[metric]], False
 
-    def emit_filesystem_metrics(self, container_name, container_id, metrics):
-        """ parse filesystem metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; output metric """
+    def emit_filesystem_metrics(self, metrics):
+        """ parse filesystem metric structure; create a collectd'ish metric name; map metric value(s) to collectd types; yield records """
         plugin = 'fs'
         plugin_instance = None
         metric_type = None
@@ -492,125 +1243,252 @@ class CAdvisor(object):
             metric_type = 'bytes'
             for stat in ('capacity', 'usage'):
                 type_instance = stat
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device[stat]])
+                yield plugin, plugin_instance, metric_type, type_instance, [device[stat]], False
 
             metric_type = 'time_ms'
             for stat in ('read_time', 'io_time', 'weighted_io_time', 'write_time'):
                 type_instance = stat
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device[stat]])
+                yield plugin, plugin_instance, metric_type, type_instance, [device[stat]], False
 
             metric_type = 'gauge'
             for stat in ('writes_completed', 'reads_completed', 'writes_merged', 'sectors_written', 'reads_merged', 'sectors_read'):
                 type_instance = stat
-                self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device[stat]])
+                yield plugin, plugin_instance, metric_type, type_instance, [device[stat]], False
 
             metric_type = 'counter'
             type_instance = 'io_in_progress'
-            self.dispatch_metric(container_name, container_id, plugin, plugin_instance, metric_type, type_instance, [device['io_in_progress']])
+            yield plugin, plugin_instance, metric_type, type_instance, [device['io_in_progress']], False
 
-    def output_metrics(self, container_name, container_id, metrics, fs_metrics=False):
-        """ parcel out the various metric sections to dedicated (isolated) handlers for each of the distinct structures. """
+    def output_samples(self, container_name, container_id, stats, fs_metrics=False):
+        """
+        output the newest sample of a cgroup's stats, preceded by any older samples (count > 1, backfill)
+        which are newer than the last sample output for the cgroup, thinned out to about one per read interval
+        """
+        if len(stats) == 1:
+            self.output_metrics(container_name, container_id, stats[0], fs_metrics)
+            return
+
+        container_key = (container_name, container_id)
+        samples = sorted((self.parse_timestamp(sample['timestamp']), sample) for sample in stats if 'timestamp' in sample)
+        if not samples:
+            self.output_metrics(container_name, container_id, stats[-1], fs_metrics)
+            return
+        self.housekeeping_interval = self.housekeeping_interval * 0.8 + (samples[-1][0] - samples[0][0]) / (len(samples) - 1) * 0.2
+
+        last = self.sample_times.get(container_key, None)
+        spacing = 0.9 * (self.read_interval or 0)
+        if last is not None:
+            for sample_time, sample in samples[0:-1]:
+                if sample_time > last and sample_time - last >= spacing and samples[-1][0] - sample_time >= spacing:
+                    self.output_metrics(container_name, container_id, sample, fs_metrics, sample_time, True)
+                    last = sample_time
+        self.output_metrics(container_name, container_id, samples[-1][1], fs_metrics, samples[-1][0])
+
+    def output_metrics(self, container_name, container_id, metrics, fs_metrics=False, sample_time=None, backfilled=False):
+        """
+        parcel out the various metric sections to dedicated (isolated) handlers for each of the distinct structures.
+        backfilled samples are always dispatched with their own timestamp
+        """
 
-        if metrics['has_cpu'] and 'cpu' in self.active_metrics:
-            self.emit_cpu_metrics(container_name, container_id, metrics['cpu'])
+        self.containers_seen.add((container_name, container_id))
+        if sample_time is None:
+            sample_time = self.parse_timestamp(metrics['timestamp']) if 'timestamp' in metrics else time.time()
+        self.sample_time = sample_time
+        self.dispatch_time = sample_time if self.sample_timestamps or backfilled else None
+        if self.backfill:
+            self.sample_times[(container_name, container_id)] = sample_time
 
-        if metrics['has_memory'] and 'memory' in self.active_metrics:
-            self.emit_memory_metrics(container_name, container_id, metrics['memory'])
+        self.container_key = (container_name, container_id)
+        self.dispatch_records(container_name, container_id, self.metric_records(metrics, fs_metrics))
 
-        if metrics['has_network'] and 'network' in self.active_metrics:
-            self.emit_network_metrics(container_name, container_id, metrics['network'])
+    def metric_records(self, metrics, fs_metrics=False):
+        """ the records of a sample, of the container self.container_key, taken at self.sample_time """
+        records = []
 
-        if metrics['has_diskio'] and 'diskio' in self.active_metrics:
-            self.emit_diskio_metrics(container_name, container_id, metrics['diskio'])
+        if metrics['has_cpu'] and self.metric_plan.get('cpu', None):
+            records.extend(self.emit_cpu_metrics(metrics['cpu']))
 
-        if metrics['has_load'] and 'load_stats' in self.active_metrics:
-            self.emit_load_metrics(container_name, container_id, metrics['load_stats'])
+        if metrics['has_memory'] and self.metric_plan.get('memory', None):
+            records.extend(self.emit_memory_metrics(metrics['memory']))
 
-        if metrics['has_filesystem'] and fs_metrics:
-            self.emit_filesystem_metrics(container_name, container_id, metrics['filesystem'])
+        if metrics['has_network'] and self.metric_plan.get('network', None):
+            records.extend(self.emit_network_metrics(metrics['network']))
 
-    def emit_metrics(self, metrics):
-        """walk through retrieved CAdvisor metrics output each metric for collectd"""
-        for service in metrics.keys():
-            if service == '/':
-                if self.system_enabled:
-                    self.output_metrics('sys', 0, metrics[service][0], self.system_fs_metrics)
-                else:
-                    continue
-            elif service == '/system.slice':
-                if self.system_services['options']['include_system_slice']:
-                    self.output_metrics('sys.slice', 0, metrics[service][0], False)
-                else:
-                    continue
-            elif service == '/user.slice':
-                if self.system_services['options']['include_user_slice']:
-                    self.output_metrics('usr.slice', 0, metrics[service][0], False)
-                else:
-                    continue
-            elif service[-6:] == '.slice':
-                if self.system_services['options']['include_other_slices']:
-                    self.output_metrics('oth.slice', 0, metrics[service][0], False)
-                else:
-                    continue
-            elif service[-6:] == '.mount':
-                if self.system_services['options']['include_mounts']:
-                    self.output_metrics('mount', 0, metrics[service][0], False)
-                else:
-                    continue
-            elif service[-8:] == '.sockets':
-                if self.system_services['options']['include_sockets']:
-                    self.output_metrics('socket', 0, metrics[service][0], False)
-                else:
-                    continue
-            elif service[0:21] == '/system.slice/docker-' and service[-6:] == '.scope':
-                if self.system_services['options']['include_docker_scopes']:
-                    self.output_metrics('docker', 0, metrics[service][0], False)
-                else:
-                    continue
-            else:
-
-                try:
-                    real_service_name = service.split('/')[-1].replace('.service', '.svc')
-                except (ValueError, KeyError):
-                    real_service_name = service
+        if metrics['has_diskio'] and self.metric_plan.get('diskio', None):
+            records.extend(self.emit_diskio_metrics(metrics['diskio']))
 
-                real_service_name = real_service_name.replace('\x2d', "\x2d")
+        if metrics['has_load'] and self.metric_plan.get('load_stats', None):
+            records.extend(self.emit_load_metrics(metrics['load_stats']))
 
-                if self.service_filter == 'all':
-                    self.output_metrics(real_service_name, 0, metrics[service][0], False)
-
-                elif self.service_filter == 'include':
-                    for elem in self.system_services['include']:
-                        if elem in service:
-                            self.output_metrics(real_service_name, 0, metrics[service][0], False)
-
-                elif self.service_filter == 'exclude':
-                    cleared = 0
-
-                    for elem in self.system_services['exclude']:
-                        if elem not in service:
-                            cleared += 1
+        if metrics['has_filesystem'] and fs_metrics:
+            records.extend(self.emit_filesystem_metrics(metrics['filesystem']))
+
+        return(records)
+
+    def container_rank(self, container_key, sample):
+        """ the rank_by value of a container's newest sample, higher ranks first """
+        if self.rank_by == 'memory':
+            return(sample['memory']['working_set'] if sample.get('has_memory', False) else 0)
+
+        if not sample.get('has_cpu', False):
+            return(0)
+        sample_time = self.parse_timestamp(sample['timestamp']) if 'timestamp' in sample else time.time()
+        usage = sample['cpu']['usage']['total']
+        previous = self.container_ranks.get(container_key, None)
+        self.container_ranks[container_key] = (sample_time, usage)
+        # new containers rank last until they have a rate
+        if previous is None or sample_time <= previous[0] or usage < previous[1]:
+            return(0)
+        return((usage - previous[1]) / (sample_time - previous[0]))
+
+    def output_containers(self, containers):
+        """
+        output the top max_containers of (container name, container id, stats) by rank_by, sum the rest into
+        the OTHER container: gauges as they are, cumulative counters as per second rates (<type>_rate).
+        the per cpu aggregates are left out, a sum of minimums, maximums or percentiles means nothing
+        """
+        ranked = sorted(containers, key=lambda container: self.container_rank(container[0:2], container[2][-1]), reverse=True)
+        for container_name, container_id, stats in ranked[0:self.max_containers]:
+            self.output_samples(container_name, container_id, stats)
+
+        others = ranked[self.max_containers:]
+        collector_stats = self.collector_stats
+        collector_stats['containers_suppressed'] = len(others)
+        collector_stats['series_suppressed'] = 0
+        if not others:
+            return
+
+        totals = {}
+        order = []
+        for container_name, container_id, stats in others:
+            container_key = (container_name, container_id)
+            # kept, so the container's state (rates, ranks) survives while it is in the OTHER bucket
+            self.containers_seen.add(container_key)
+            sample = stats[-1]
+            self.container_key = container_key
+            self.sample_time = self.parse_timestamp(sample['timestamp']) if 'timestamp' in sample else time.time()
+            records = self.metric_records(sample)
+            collector_stats['series_suppressed'] += len(records)
+            for plugin, plugin_instance, metric_type, type_instance, metric_value, cumulative in records:
+                if plugin_instance == self.PER_CPU_AGGREGATE and plugin == 'cpu':
+                    continue
+                if cumulative:
+                    metric_value = self.other_rates.rate(container_key, (plugin, plugin_instance, metric_type, type_instance), self.sample_time, metric_value)
+                    if metric_value is None:
+                        continue
+                    metric_type = self.instance_name('{}_rate', metric_type)
+                series_key = (plugin, plugin_instance, metric_type, type_instance)
+                total = totals.get(series_key, None)
+                if total is None:
+                    totals[series_key] = list(metric_value)
+                    order.append(series_key)
+                else:
+                    for i, value in enumerate(metric_value):
+                        total[i] += value
 
-                    if cleared == len(self.system_services['exclude']):
-                        self.output_metrics(real_service_name, 0, metrics[service][0], False)
+        self.containers_seen.add(self.OTHER)
+        self.container_key = self.OTHER
+        self.sample_time = time.time()
+        self.dispatch_time = None
+        self.dispatch_records(self.OTHER[0], self.OTHER[1], [series_key + (totals[series_key], False) for series_key in order])
 
-                else:
-                        self.log_error("rut roh...There's an elephant in the room, never should have gotten here!")
-                        sys.exit(10)
+    def compile_service_patterns(self, patterns):
+        """
+        one regex for a list of system_services include/exclude patterns, None if there are none
+        a pattern matches anywhere in the cgroup path, '*' and '?' in a pattern are wildcards
+        """
+        parts = []
+        for pattern in patterns:
+            if pattern is None or pattern == '*':
+                continue
+            parts.append(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in str(pattern)))
+        if not parts:
+            return(None)
+        return(re.compile('|'.join(parts)))
+
+    def classify_service(self, service):
+        """ (name, fs_metrics) a (non-docker) cgroup is output as, None if the system configuration does not call for it """
+        options = self.system_services['options']
+        if service == '/':
+            return(('sys', self.system_fs_metrics) if self.system_enabled else None)
+        elif service == '/system.slice':
+            return(('sys.slice', False) if options['include_system_slice'] else None)
+        elif service == '/user.slice':
+            return(('usr.slice', False) if options['include_user_slice'] else None)
+        elif service[-6:] == '.slice':
+            return(('oth.slice', False) if options['include_other_slices'] else None)
+        elif service[-6:] == '.mount':
+            return(('mount', False) if options['include_mounts'] else None)
+        elif service[-8:] == '.sockets':
+            return(('socket', False) if options['include_sockets'] else None)
+        elif service[0:21] == '/system.slice/docker-' and service[-6:] == '.scope':
+            return(('docker', False) if options['include_docker_scopes'] else None)
+
+        real_service_name = service.split('/')[-1].replace('.service', '.svc')
+        if self.service_filter == 'all':
+            selected = True
+        elif self.service_filter == 'include':
+            selected = self.service_match is not None and self.service_match.search(service) is not None
+        else:
+            selected = self.service_match is None or self.service_match.search(service) is None
+        return((real_service_name, False) if selected else None)
 
-        if self.docker_enabled:
-            #
-            # dynamic items needed for each fetch run.
-            #   list of running containers from docker
-            #   slice ids for running containers
-            #
-            self.set_docker_container_list()
-            self.set_container_slice_ids()
-            for docker_container in self.docker_container_list:
-                if docker_container['SliceId']:
+    def emit_service_metrics(self, service, stats):
+        """ output a (non-docker) cgroup's metrics if the system configuration calls for it, one cached lookup per cgroup """
+        try:
+            decision = self.service_decisions[service]
+        except KeyError:
+            decision = self.service_decisions[service] = self.classify_service(service)
+        if decision is not None:
+            self.output_samples(decision[0], 0, stats, decision[1])
 
-                    for key in metrics.keys():
-                        if docker_container['Id'] in key:
-                            self.output_metrics(''.join(docker_container['Names']).replace('/', ''), docker_container['Id'][0:12], metrics[key][0])
-                            break
+    def emit_metrics(self, metrics):
+        """
+        walk through retrieved CAdvisor metrics output each metric for collectd
+        metrics is either the dict returned by fetch_metrics or, in streaming mode, an iterable of (cgroup, stats) pairs
+        """
+        if isinstance(metrics, dict):
+            metrics = metrics.iteritems()
+
+        # container list, slice ids and the container index are refreshed by fetch_metrics
+        container_index = self.container_index if self.docker_enabled and self.container_index else {}
+        emitted = set()
+        start = time.time()
+        self.values_dispatched = 0
+        cgroups = 0
+        # max_containers, the containers are ranked once they have all been seen
+        limited = [] if self.max_containers > 0 else None
+
+        for service, stats in metrics:
+            cgroups += 1
+            self.emit_service_metrics(service, stats)
+
+            if container_index:
+                container_id = self.cgroup_container_id(service)
+                if container_id in container_index and container_id not in emitted:
+                    emitted.add(container_id)
+                    docker_container = container_index[container_id]
+                    if limited is not None:
+                        limited.append((docker_container['MetricName'], container_id[0:12], stats))
+                    else:
+                        self.output_samples(docker_container['MetricName'], container_id[0:12], stats)
+
+        if limited is not None:
+            self.output_containers(limited)
+
+        collector_stats = self.collector_stats
+        collector_stats['emit'] = time.time() - start
+        collector_stats['cgroups_seen'] = cgroups
+        # containers summed into OTHER are seen (their state is kept) but not emitted
+        collector_stats['cgroups_emitted'] = len(self.containers_seen - set([self.COLLECTOR, self.OTHER])) - collector_stats.get('containers_suppressed', 0)
+        collector_stats['values'] = self.values_dispatched
+
+        # forget the decisions for cgroups which have come and gone
+        if len(self.service_decisions) > 2 * cgroups + 1024:
+            self.service_decisions = {}
+
+        if self.fetch_complete:
+            self.evict_containers()
+        if self.self_metrics:
+            self.emit_collector_metrics()
 # END
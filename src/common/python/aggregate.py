@@ -0,0 +1,79 @@
+#
+# Array backed aggregation of wide per-cpu (and per-device) metrics
+#
+# numpy is used when it is installed, the array module otherwise
+#
+
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AGGREGATES = ('min', 'max', 'avg', 'p95')
+
+
+def to_array(values):
+    """ a list of numbers as a typed (float) array """
+    if numpy is not None:
+        return(numpy.array(values, dtype=numpy.float64))
+    return(array('d', values))
+
+
+def summarize(values):
+    """ (min, max, avg, p95) of a non-empty array, p95 is the nearest rank """
+    rank = int(math.ceil(0.95 * len(values))) - 1
+    if numpy is not None:
+        ordered = numpy.sort(values)
+        return((float(ordered[0]), float(ordered[-1]), float(ordered.mean()), float(ordered[rank])))
+    ordered = sorted(values)
+    return((ordered[0], ordered[-1], math.fsum(ordered) / len(ordered), ordered[rank]))
+
+
+class CounterArrays(object):
+    """
+    per second rates of arrays of cumulative counters (e.g. per_cpu_usage), computed across the whole
+    array at once. the previous sample is kept per container, like RateEngine's state.
+    """
+
+    def __init__(self):
+        super(CounterArrays, self).__init__()
+        self.state = {}
+        self.counters = {'resets': 0}
+
+    def rates(self, container_key, timestamp, values):
+        """
+        array of per second rates since the previous sample, None for the first sample, when the number
+        of counters changed, after a counter reset (any went down) or when the sample is not newer
+        """
+        current = to_array(values)
+        previous = self.state.get(container_key, None)
+        if previous is None or len(previous[1]) != len(current):
+            self.state[container_key] = (timestamp, current)
+            return(None)
+
+        previous_timestamp, previous_values = previous
+        elapsed = timestamp - previous_timestamp
+        if elapsed <= 0:
+            return(None)
+        self.state[container_key] = (timestamp, current)
+
+        if numpy is not None:
+            deltas = current - previous_values
+            if (deltas < 0).any():
+                self.counters['resets'] += 1
+                return(None)
+            return(deltas / elapsed)
+
+        rates = array('d', [value - previous_value for value, previous_value in zip(current, previous_values)])
+        if min(rates) < 0:
+            self.counters['resets'] += 1
+            return(None)
+        return(array('d', [delta / elapsed for delta in rates]))
+
+    def evict(self, container_key):
+        self.state.pop(container_key, None)
+
+# END
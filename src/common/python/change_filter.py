@@ -0,0 +1,55 @@
+#
+# Change-only (deadband) emission, suppress values which have not moved since they were last sent
+#
+
+
+class ChangeFilter(object):
+    """
+    a value is sent when it differs from the value last sent for the series by more than deadband
+    (a fraction of the value last sent, 0 for any change), and at least once every heartbeat intervals
+    regardless, so series never go quiet for long enough to look missing downstream.
+
+    state is grouped (e.g. by container) so a whole group can be evicted at once
+    """
+
+    def __init__(self, deadband=0.0, heartbeat=10):
+        super(ChangeFilter, self).__init__()
+        self.deadband = float(deadband)
+        self.heartbeat = max(1, int(heartbeat))
+        self.state = {}
+        self.counters = {'sent': 0, 'suppressed': 0}
+
+    def changed(self, group_key, series_key, values):
+        """ True if values are to be sent, values is a sequence (one entry per data source) """
+        series = self.state.get(group_key, None)
+        if series is None:
+            series = self.state[group_key] = {}
+        last = series.get(series_key, None)
+        if last is not None and last[1] < self.heartbeat - 1 and self.within(last[0], values):
+            last[1] += 1
+            self.counters['suppressed'] += 1
+            return(False)
+        series[series_key] = [values, 0]
+        self.counters['sent'] += 1
+        return(True)
+
+    def within(self, sent, values):
+        """ True if every value is within the deadband of the value sent """
+        if len(sent) != len(values):
+            return(False)
+        deadband = self.deadband
+        for previous, value in zip(sent, values):
+            if deadband:
+                if abs(value - previous) > abs(previous) * deadband:
+                    return(False)
+            elif value != previous:
+                return(False)
+        return(True)
+
+    def evict(self, group_key):
+        self.state.pop(group_key, None)
+
+    def clear(self):
+        self.state = {}
+
+# END
@@ -0,0 +1,292 @@
+#
+# Direct write-out of values as Graphite plaintext or InfluxDB line protocol, bypassing collectd's
+# dispatch queue and write plugins
+#
+
+from abc import ABCMeta, abstractmethod
+
+import re
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+from http_pool import shared_pool
+
+# data source names of the multi-value types dispatched (collectd types.db and cadvisor-types.db)
+DS_NAMES = dict(('if_{}{}'.format(item, suffix), ('rx', 'tx')) for item in ('octets', 'packets', 'errors', 'dropped') for suffix in ('', '_rate'))
+
+
+def ds_names(metric_type):
+    """ names of the values of a series of metric_type, ('value',) for single value types """
+    return(DS_NAMES.get(metric_type, ('value',)))
+
+
+class SendError(IOError):
+    """ shipping failed after the first sent bytes (whole lines) of the data went out """
+
+    def __init__(self, message, sent=0):
+        super(SendError, self).__init__(message)
+        self.sent = sent
+
+
+class DirectWriter(object):
+    """
+    buffers the lines of an interval and ships them in bulk with flush(), once per interval
+    series() is called once per series (cached by the caller) and returns what format_lines() needs
+    to format a line with the least work. write_all() formats a batch of values sharing a timestamp.
+
+    writers are shared by the plugin instances writing to the same destination, from their own
+    read threads: the buffer is only touched under lock, flushes are serialized by send_lock (so
+    writes carry on while a flush is being shipped).
+    a failed flush keeps the lines not shipped for the next one, up to max_buffer lines (the oldest are dropped),
+    a batch the server rejects (http 4xx) is dropped
+
+    counters:
+        lines   - lines shipped
+        flushes - successful flushes
+        bytes   - bytes shipped
+        errors  - failed flushes
+        dropped - lines dropped (buffer full)
+
+    tagged is False when series() leaves tags out, callers then have to put what they identify in the path
+    """
+    __metaclass__ = ABCMeta
+
+    tagged = True
+
+    def __init__(self, host, port, hostname=None, max_buffer=100000, timeout=5, log_error=None):
+        super(DirectWriter, self).__init__()
+        self.host = host
+        self.port = int(port)
+        self.hostname = hostname or socket.gethostname()
+        self.max_buffer = int(max_buffer)
+        self.timeout = timeout
+        self.log_error = log_error or (lambda msg: None)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.lines = []
+        self.counters = {'lines': 0, 'flushes': 0, 'bytes': 0, 'errors': 0, 'dropped': 0}
+
+    @abstractmethod
+    def series(self, host, plugin, plugin_instance, metric_type, type_instance, tags=None):
+        """ what format_lines() needs to format the lines of a series """
+        pass
+
+    @abstractmethod
+    def format_lines(self, items, suffix):
+        """ the lines of (series, values) items, each ending with suffix, values not matching the series' type are left out """
+        pass
+
+    @abstractmethod
+    def send(self, data):
+        """ ship data, raise (IOError, socket.error...) on failure, SendError when part of it was shipped """
+        pass
+
+    @abstractmethod
+    def format_timestamp(self, timestamp):
+        """ a timestamp (epoch seconds) as the protocol has it """
+        pass
+
+    def write(self, series, timestamp, values):
+        """ buffer a line for values (timestamp None for now) """
+        self.write_all([(series, values)], timestamp)
+
+    def write_all(self, items, timestamp):
+        """ buffer a line for each (series, values) of items, all taken at timestamp (None for now) """
+        lines = self.format_lines(items, ' {}\n'.format(self.format_timestamp(timestamp or time.time())))
+        with self.lock:
+            self.lines.extend(lines)
+
+    def flush(self):
+        with self.send_lock:
+            with self.lock:
+                lines = self.lines
+                self.lines = []
+            if not lines:
+                return
+            data = ''.join(lines)
+            try:
+                self.send(data)
+            except urllib2.HTTPError, e:
+                if e.code >= 500:
+                    self.requeue(lines, data, e)
+                    return
+                # rejected (e.g. 400, a line the server will not take), sending it again would fail again
+                self.counters['errors'] += 1
+                self.counters['dropped'] += len(lines)
+                self.log_error('{}:{} rejected {} lines, dropped: {}'.format(self.host, self.port, len(lines), e))
+                return
+            except (IOError, socket.error), e:
+                self.requeue(lines, data, e)
+                return
+            self.counters['lines'] += len(lines)
+            self.counters['flushes'] += 1
+            self.counters['bytes'] += len(data)
+
+    def requeue(self, lines, data, e):
+        """ after a failed send (e) of data, keep the lines not shipped for the next flush """
+        sent = getattr(e, 'sent', 0)
+        shipped = data.count('\n', 0, sent)
+        self.counters['errors'] += 1
+        self.counters['lines'] += shipped
+        self.counters['bytes'] += sent
+        self.log_error('Unable to write {} lines to {}:{}: {}'.format(len(lines) - shipped, self.host, self.port, e))
+        with self.lock:
+            # ahead of the lines written since, in order
+            lines = lines[shipped:] + self.lines
+            if len(lines) > self.max_buffer:
+                self.counters['dropped'] += len(lines) - self.max_buffer
+                lines = lines[-self.max_buffer:]
+            self.lines = lines
+
+
+class GraphiteWriter(DirectWriter):
+    """
+    graphite plaintext protocol over a persistent tcp connection (re-established, once, when it fails)
+        [prefix]host.plugin[.plugin_instance].type[.type_instance][.ds][;tag=value...] value timestamp
+    tags (container name and id) use graphite 1.1 tag syntax, tags: false leaves them out (not tagged)
+    """
+    UNSAFE = re.compile(r'[\s.;~!^=]')
+
+    def __init__(self, host, port=2003, prefix='', tags=True, **kwargs):
+        super(GraphiteWriter, self).__init__(host, port, **kwargs)
+        self.prefix = prefix or ''
+        self.tagged = bool(tags)
+        self.sock = None
+
+    def series(self, host, plugin, plugin_instance, metric_type, type_instance, tags=None):
+        path = [self.UNSAFE.sub('_', str(host)), self.UNSAFE.sub('_', str(plugin))]
+        if plugin_instance:
+            path.append(self.UNSAFE.sub('_', str(plugin_instance)))
+        path.append(self.UNSAFE.sub('_', str(metric_type)))
+        if type_instance:
+            path.append(self.UNSAFE.sub('_', str(type_instance)))
+        suffix = ''
+        if self.tagged and tags:
+            suffix = ''.join(';{}={}'.format(key, self.UNSAFE.sub('_', str(tags[key]))) for key in sorted(tags) if tags[key] not in (None, ''))
+        path = self.prefix + '.'.join(path)
+        names = ds_names(metric_type)
+        if len(names) == 1:
+            return(('{}{} '.format(path, suffix),))
+        return(tuple('{}.{}{} '.format(path, ds, suffix) for ds in names))
+
+    def format_timestamp(self, timestamp):
+        return(int(timestamp))
+
+    def format_lines(self, items, suffix):
+        lines = []
+        for series, values in items:
+            # repr, str rounds floats to 12 significant digits
+            if len(series) == 1 and len(values) == 1:
+                lines.append(series[0] + repr(float(values[0])) + suffix)
+            elif len(series) == len(values):
+                lines.extend([name + repr(float(value)) + suffix for name, value in zip(series, values)])
+        return(lines)
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data):
+        # bytes handed to the connection, after a reconnect the line cut short (if any) is sent again, not the rest
+        sent = 0
+        view = memoryview(data)
+        for attempt in (1, 2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                while sent < len(data):
+                    sent += self.sock.send(view[sent:])
+                return
+            except socket.error, e:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                sent = data.rfind('\n', 0, sent) + 1
+                # a connection which went away while idle is only noticed when written to
+                if attempt == 2:
+                    raise SendError(str(e), sent)
+
+
+class InfluxWriter(DirectWriter):
+    """
+    influxdb line protocol, POSTed to /write over the keep-alive connection pool
+        plugin,host=..,instance=..,type=..,type_instance=..[,tag=value...] value=..|rx=..,tx=.. timestamp(ms)
+    """
+    ESCAPE = re.compile(r'([,= ])')
+
+    def __init__(self, host, port=8086, database='collectd', retention_policy=None, **kwargs):
+        super(InfluxWriter, self).__init__(host, port, **kwargs)
+        query = {'db': database, 'precision': 'ms'}
+        if retention_policy:
+            query['rp'] = retention_policy
+        self.path = '/write?{}'.format(urllib.urlencode(sorted(query.items())))
+        self.http_pool = shared_pool()
+
+    def series(self, host, plugin, plugin_instance, metric_type, type_instance, tags=None):
+        all_tags = {'host': host, 'instance': plugin_instance, 'type': metric_type, 'type_instance': type_instance}
+        all_tags.update(tags or {})
+        key = [self.ESCAPE.sub(r'\\\1', str(plugin))]
+        for tag in sorted(all_tags):
+            if all_tags[tag] not in (None, ''):
+                key.append('{}={}'.format(tag, self.ESCAPE.sub(r'\\\1', str(all_tags[tag]))))
+        return(('{} '.format(','.join(key)), tuple('{}='.format(ds) for ds in ds_names(metric_type))))
+
+    def format_timestamp(self, timestamp):
+        return(int(timestamp * 1000))
+
+    def format_lines(self, items, suffix):
+        lines = []
+        for (key, fields), values in items:
+            if len(fields) == 1 and len(values) == 1:
+                lines.append(key + fields[0] + repr(float(values[0])) + suffix)
+            elif len(fields) == len(values):
+                lines.append(key + ','.join([field + repr(float(value)) for field, value in zip(fields, values)]) + suffix)
+        return(lines)
+
+    def send(self, data):
+        self.http_pool.post(self.host, self.port, self.path, data, {'Content-Type': 'text/plain'}, self.timeout)
+
+
+WRITERS = {'graphite': GraphiteWriter, 'influxdb': InfluxWriter}
+
+#
+# one writer per destination per interpreter, shared by every plugin instance and target writing to it
+#
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def shared_writer(output, log_error=None):
+    """
+    the writer for an output configuration (dict), None for the default (collectd) output
+        type: collectd (default), graphite or influxdb
+        host, port: destination (port defaults to 2003 graphite, 8086 influxdb)
+        hostname: host the values are attributed to (default: this host's name)
+        prefix, tags: graphite path prefix, whether to add container name/id as graphite tags
+        database, retention_policy: influxdb
+        max_buffer: lines kept while the destination is unreachable
+        timeout: seconds
+    raises ValueError on an unknown type
+    """
+    output = dict(output or {})
+    kind = str(output.pop('type', 'collectd')).lower()
+    if kind == 'collectd':
+        return(None)
+    if kind not in WRITERS:
+        raise ValueError('unknown output type "{}", expected collectd, {}'.format(kind, ', '.join(sorted(WRITERS))))
+    if not output.get('host'):
+        raise ValueError('no host for {} output'.format(kind))
+    # every setting is part of the key, plugins configured differently (hostname, tags...) get their own writer
+    key = (kind,) + tuple(sorted(output.items()))
+    with _writers_lock:
+        if key not in _writers:
+            try:
+                _writers[key] = WRITERS[kind](log_error=log_error, **output)
+            except TypeError, e:
+                raise ValueError('invalid {} output setting: {}'.format(kind, e))
+        return(_writers[key])
+
+# END
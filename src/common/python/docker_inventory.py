@@ -0,0 +1,134 @@
+#
+# Running container inventory, kept current from the docker events stream
+#
+
+import json
+import threading
+import time
+
+import docker
+
+
+class DockerInventory(object):
+    """
+    cache of the running docker containers, in the same form as docker-py's Client.containers()
+    (only the 'Id' and 'Names' keys are guaranteed).
+
+    a background thread follows the docker /events stream and applies container start/die/destroy/rename
+    events as they happen, a second thread does a full resync every resync_interval seconds as a safety
+    net for anything missed. readers never touch the docker socket after the initial sync.
+    """
+
+    ADD_EVENTS = ('start', 'unpause', 'rename', 'update')
+    REMOVE_EVENTS = ('die', 'destroy')
+
+    def __init__(self, docker_socket, resync_interval=300, log_error=None, log_info=None):
+        super(DockerInventory, self).__init__()
+        self.docker_url = 'unix:/{}'.format(docker_socket)
+        self.resync_interval = resync_interval
+        self.log_error = log_error or (lambda msg: None)
+        self.log_info = log_info or (lambda msg: None)
+        self.inventory = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.threads = []
+        self.last_event = None
+
+    def client(self):
+        return(docker.Client(base_url=self.docker_url))
+
+    def start(self):
+        """
+        synchronous initial sync (errors propagate to the caller), then start the background threads
+        """
+        self.resync()
+        if self.threads:
+            return
+        for target in (self.follow_events, self.periodic_resync):
+            thread = threading.Thread(target=target, name='docker-inventory-{}'.format(target.__name__))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def started(self):
+        return(len(self.threads) > 0)
+
+    def add_listener(self, callback):
+        """ callback(status, container_id) is called for every container event applied """
+        self.listeners.append(callback)
+
+    def containers(self):
+        """ snapshot of the running containers, callers may modify the returned dicts """
+        with self.lock:
+            return([dict(container) for container in self.inventory.itervalues()])
+
+    def resync(self):
+        """ replace the inventory with a full container list from docker """
+        containers = self.client().containers(all=False)
+        with self.lock:
+            self.inventory = dict((container['Id'], container) for container in containers)
+            self.version += 1
+
+    def periodic_resync(self):
+        while True:
+            time.sleep(self.resync_interval)
+            try:
+                self.resync()
+            except Exception, e:
+                self.log_error('Docker inventory resync failed, keeping previous inventory: {}'.format(e))
+
+    def follow_events(self):
+        """ follow the docker events stream, reconnecting (and catching up from the last event seen) on failure """
+        backoff = 1
+        while True:
+            try:
+                cli = self.client()
+                since = self.last_event
+                for event in cli.events(since=since) if since else cli.events():
+                    backoff = 1
+                    self.apply_event(cli, event)
+            except Exception, e:
+                self.log_error('Docker events stream interrupted, reconnecting in {}s: {}'.format(backoff, e))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def apply_event(self, cli, event):
+        """
+        apply a single docker event, both the pre 1.10 ('status', 'id') and later ('Type', 'Action', 'Actor') forms
+        the stream resumes after the last event applied, an event which failed is seen again on reconnect
+        """
+        if isinstance(event, basestring):
+            event = json.loads(event)
+        if event.get('Type', 'container') == 'container':
+            status = event.get('status', event.get('Action', ''))
+            container_id = event.get('id', event.get('Actor', {}).get('ID', None))
+            if container_id:
+                self.apply_container_event(cli, status, container_id)
+        self.last_event = event.get('time', self.last_event)
+
+    def apply_container_event(self, cli, status, container_id):
+        if status in self.ADD_EVENTS:
+            try:
+                info = cli.inspect_container(container_id)
+            except docker.errors.APIError:
+                # gone already (NotFound), a short lived container, its die/destroy events follow
+                return
+            if not info['State']['Running']:
+                return
+            container = {'Id': info['Id'], 'Names': ['/' + info['Name'].lstrip('/')]}
+            with self.lock:
+                self.inventory[container['Id']] = container
+                self.version += 1
+        elif status in self.REMOVE_EVENTS:
+            with self.lock:
+                if self.inventory.pop(container_id, None) is None:
+                    return
+                self.version += 1
+        else:
+            return
+
+        for callback in self.listeners:
+            callback(status, container_id)
+
+# END
@@ -0,0 +1,180 @@
+#
+# Keep-alive HTTP connection pool shared by the CAdvisor and Mesos plugins
+#
+
+import httplib
+import socket
+import threading
+import time
+import urllib2
+
+
+class PooledResponse(object):
+    """
+    thin wrapper around an httplib response
+    the connection is handed back to the pool as soon as the body has been read completely,
+    closing the response early discards the connection (it is in an unknown state)
+    """
+
+    def __init__(self, pool, key, conn, response):
+        super(PooledResponse, self).__init__()
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.bytes_read = 0
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        self.bytes_read += len(data)
+        if self.response.isclosed():
+            self.release()
+        return(data)
+
+    def release(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.checkin(self.key, self.conn)
+        else:
+            self.pool.discard(self.conn)
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None and not self.response.isclosed():
+            self.pool.discard(self.conn)
+            self.conn = None
+        self.release()
+
+
+class HTTPConnectionPool(object):
+    """
+    pool of persistent (HTTP/1.1 keep-alive) connections, keyed by host:port
+
+    max_size: maximum number of idle connections kept per host:port
+    idle_timeout: idle connections older than this (seconds) are closed instead of reused
+    """
+
+    def __init__(self, max_size=4, idle_timeout=30):
+        super(HTTPConnectionPool, self).__init__()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.counters = {'opened': 0, 'reused': 0, 'reconnected': 0, 'expired': 0}
+
+    def configure(self, max_size=None, idle_timeout=None):
+        with self.lock:
+            if max_size is not None:
+                self.max_size = max(1, int(max_size))
+            if idle_timeout is not None:
+                self.idle_timeout = float(idle_timeout)
+
+    def stats(self):
+        """ snapshot of the connection counters """
+        with self.lock:
+            return(dict(self.counters))
+
+    def checkout(self, key, timeout):
+        """ return (connection, reused) -- most recently used idle connection first """
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    self.counters['expired'] += 1
+                    conn.close()
+                    continue
+                self.counters['reused'] += 1
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return(conn, True)
+            self.counters['opened'] += 1
+        return(httplib.HTTPConnection(key[0], key[1], timeout=timeout), False)
+
+    def checkin(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+    def close(self):
+        """ close all idle connections """
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, last_used in idle:
+                    conn.close()
+            self.idle = {}
+
+    def urlopen(self, host, port, path, timeout=5, method='GET', body=None, headers=None):
+        """
+        issue a GET (or method, with body) for path on host:port, return a PooledResponse
+
+        raises the same exceptions urllib2.urlopen would for the callers' benefit:
+            socket.timeout on timeout
+            urllib2.HTTPError on a non-2xx response
+            urllib2.URLError on any other connection failure
+        a reused connection which turns out to be stale (closed by the server while idle) is
+        transparently replaced with a new connection, once.
+        """
+        key = (host, int(port))
+        url = 'http://{}:{}{}'.format(host, port, path)
+        request_headers = {'Connection': 'keep-alive'}
+        if headers:
+            request_headers.update(headers)
+        conn, reused = self.checkout(key, timeout)
+        while True:
+            try:
+                conn.request(method, path, body, request_headers)
+                response = conn.getresponse()
+                break
+            except socket.timeout:
+                conn.close()
+                raise
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused:
+                    with self.lock:
+                        self.counters['reconnected'] += 1
+                        self.counters['opened'] += 1
+                    conn, reused = httplib.HTTPConnection(key[0], key[1], timeout=timeout), False
+                    continue
+                raise urllib2.URLError(e)
+
+        pooled = PooledResponse(self, key, conn, response)
+        if not 200 <= response.status < 300:
+            body = pooled.read()
+            raise urllib2.HTTPError(url, response.status, '{} {}'.format(response.reason, body[0:200]), response.msg, None)
+        return(pooled)
+
+    def fetch(self, host, port, path, timeout=5):
+        """ convenience, urlopen and read the complete body """
+        return(self.urlopen(host, port, path, timeout).read())
+
+    def post(self, host, port, path, body, headers=None, timeout=5):
+        """ convenience, POST body to path and read the complete response """
+        return(self.urlopen(host, port, path, timeout, 'POST', body, headers).read())
+
+
+#
+# one pool per interpreter, collectd loads all python plugins into the same interpreter
+# so every cadvisor/mesos plugin instance shares (and reuses) the same connections
+#
+_shared_pool = HTTPConnectionPool()
+
+
+def shared_pool(max_size=None, idle_timeout=None):
+    """ return the interpreter wide pool, applying any settings provided """
+    _shared_pool.configure(max_size, idle_timeout)
+    return(_shared_pool)
+
+# END
@@ -0,0 +1,106 @@
+#
+# Incremental parser for large top level JSON objects (e.g. cadvisor's recursive stats)
+#
+
+import json
+
+WHITESPACE = ' \t\n\r'
+# what may follow a complete value, and how a (top level) number starts
+DELIMITERS = ',]}' + WHITESPACE
+NUMBER_START = '-0123456789'
+
+_decoder = json.JSONDecoder()
+
+
+class JSONStreamReader(object):
+    """
+    buffered reader over a file-like object (anything with read(size)) which decodes one
+    JSON value at a time. only the unparsed tail of the stream is kept in memory.
+    """
+
+    def __init__(self, fp, chunk_size=65536):
+        super(JSONStreamReader, self).__init__()
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, min_size=0):
+        """ read at least min_size more bytes (or at least one chunk), dropping the consumed prefix """
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        target = len(self.buf) + max(min_size, self.chunk_size)
+        chunks = [self.buf]
+        size = len(self.buf)
+        while size < target:
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        self.buf = ''.join(chunks)
+
+    def next_char(self):
+        """ skip whitespace and return (without consuming) the next character, '' at end of stream """
+        while True:
+            buf = self.buf
+            pos = self.pos
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(buf):
+                return(buf[pos])
+            if self.eof:
+                return('')
+            self.fill()
+
+    def expect(self, chars):
+        """ consume the next character, which must be one of chars """
+        c = self.next_char()
+        if not c or c not in chars:
+            raise ValueError('Expected one of "{}" at stream offset {}, found "{}"'.format(chars, self.pos, c))
+        self.pos += 1
+        return(c)
+
+    def decode(self):
+        """
+        decode the next complete JSON value
+        a failed (incomplete) decode doubles the pending data before retrying, so large
+        values are re-scanned a bounded number of times.
+        """
+        self.next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # a number cut by the end of the buffer ('1' of '1.5', '2e' of '2e3'...) continues in the
+                # next chunk, it is only complete once followed by a delimiter
+                if self.eof or self.buf[self.pos] not in NUMBER_START or (end < len(self.buf) and self.buf[end] in DELIMITERS):
+                    self.pos = end
+                    return(value)
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill(len(self.buf) - self.pos)
+
+
+def iter_object_items(fp, chunk_size=65536):
+    """
+    generator, yields (key, value) for each member of the top level JSON object read from fp
+    as soon as the member has been received and decoded
+    """
+    reader = JSONStreamReader(fp, chunk_size)
+    reader.expect('{')
+    if reader.next_char() == '}':
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        value = reader.decode()
+        yield key, value
+        if reader.expect(',}') == '}':
+            return
+
+# END
@@ -0,0 +1,136 @@
+#
+# Poll many cadvisor/mesos endpoints from one plugin instance
+#
+
+import os
+import Queue
+import threading
+
+import yaml
+
+
+def parse_target(target, default_port):
+    """
+    a target is either a string 'host[:port]' or a dict {host: , port: , name: }
+    returns a dict with host, port (int) and name (defaults to host)
+    """
+    if isinstance(target, dict):
+        host = str(target['host'])
+        port = int(target.get('port', default_port))
+        name = str(target.get('name', host))
+    else:
+        host, sep, port = str(target).strip().partition(':')
+        port = int(port) if sep else default_port
+        name = host
+    return({'host': host, 'port': port, 'name': name})
+
+
+class WorkerPool(object):
+    """ fixed number of daemon threads running submitted calls, map() blocks until every call has finished """
+
+    def __init__(self, workers):
+        super(WorkerPool, self).__init__()
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self.run, name='target-worker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            func, arg, results, idx = self.tasks.get()
+            try:
+                results.put((idx, func(arg), None))
+            except BaseException, e:
+                # includes SystemExit, a failing endpoint must not take a worker down with it
+                results.put((idx, None, e))
+
+    def map(self, func, args):
+        """ returns [(result, exception)] in the order of args """
+        results = Queue.Queue()
+        for idx, arg in enumerate(args):
+            self.tasks.put((func, arg, results, idx))
+        collected = [None] * len(args)
+        for i in range(len(args)):
+            idx, result, error = results.get()
+            collected[idx] = (result, error)
+        return(collected)
+
+
+class MultiTarget(object):
+    """
+    one client per endpoint, fetched concurrently by a bounded pool of workers and emitted in turn
+    by the caller (so dispatching stays on the read thread).
+
+    targets:      static list of targets (see parse_target)
+    targets_file: yaml list of targets, re-read whenever it changes
+    factory:      factory(target) returns a client for the target (an object with fetch and emit methods)
+    fetch:        name of the client method returning a complete snapshot (called on a worker thread)
+    """
+
+    def __init__(self, factory, default_port, targets=None, targets_file=None, workers=8, fetch='fetch_metrics', log_error=None):
+        super(MultiTarget, self).__init__()
+        self.factory = factory
+        self.default_port = default_port
+        self.static_targets = targets or []
+        self.targets_file = targets_file
+        self.targets_file_mtime = None
+        self.fetch_method = fetch
+        self.log_error = log_error or (lambda msg: None)
+        self.clients = {}
+        self.worker_count = workers
+        self.workers = None
+        self.set_targets(self.static_targets)
+
+    def set_targets(self, targets):
+        """ create clients for new targets, drop clients of targets no longer listed """
+        clients = {}
+        for target in targets:
+            try:
+                target = parse_target(target, self.default_port)
+            except (KeyError, ValueError), e:
+                self.log_error('Invalid target "{}" ignored: {}'.format(target, e))
+                continue
+            key = '{}:{}'.format(target['host'], target['port'])
+            clients[key] = self.clients[key] if key in self.clients else self.factory(target)
+        self.clients = clients
+
+    def refresh_targets(self):
+        """ reload targets_file if it has changed since it was last read """
+        if not self.targets_file:
+            return
+        try:
+            mtime = os.stat(self.targets_file).st_mtime
+            if mtime == self.targets_file_mtime:
+                return
+            with open(self.targets_file, 'r') as f:
+                targets = yaml.safe_load(f) or []
+            self.targets_file_mtime = mtime
+        except (IOError, OSError, yaml.YAMLError), e:
+            self.log_error('Unable to load targets file "{}", keeping current targets: {}'.format(self.targets_file, e))
+            return
+        self.set_targets(list(self.static_targets) + list(targets))
+
+    def fetch(self):
+        """ fetch every target concurrently, returns [(client, snapshot)] for the targets which succeeded """
+        if self.workers is None:
+            # started on first use, collectd may fork after configuration
+            self.workers = WorkerPool(self.worker_count)
+        self.refresh_targets()
+        targets = self.clients.items()
+        results = self.workers.map(lambda client: getattr(client, self.fetch_method)(), [client for key, client in targets])
+        snapshots = []
+        for (key, client), (snapshot, error) in zip(targets, results):
+            if error is not None:
+                self.log_error('Fetch from {} failed: {}'.format(key, error))
+                continue
+            snapshots.append((client, snapshot))
+        return(snapshots)
+
+    def emit(self, snapshots):
+        for client, snapshot in snapshots:
+            client.emit_metrics(snapshot)
+
+# END
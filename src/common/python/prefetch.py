@@ -0,0 +1,114 @@
+#
+# Background prefetch for collectd read callbacks
+#
+
+import threading
+import time
+
+
+class Prefetcher(object):
+    """
+    runs fetch() in a worker thread shortly before the next read is due, so the read callback only
+    has to dispatch the latest completed snapshot instead of waiting on the endpoint.
+
+    the read period is learned from the spacing of collect() calls, the worker wakes up `lead` seconds
+    before the next expected read. a snapshot older than max_age (default two read periods) is stale
+    and not dispatched.
+
+    counters:
+        late    - reads with no new snapshot ready (the fetch for the interval had not completed)
+        stale   - reads where the newest snapshot was too old to dispatch
+        skipped - snapshots fetched but replaced before any read dispatched them
+        failed  - fetches which raised
+    """
+
+    def __init__(self, fetch, lead=1.0, max_age=None, log_error=None):
+        super(Prefetcher, self).__init__()
+        self.fetch = fetch
+        self.lead = lead
+        self.max_age = max_age
+        self.log_error = log_error or (lambda msg: None)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.period = None
+        self.last_read = None
+        self.next_fetch = 0     # None, wait for a read to schedule the next fetch
+        self.snapshot = None
+        self.snapshot_seq = 0
+        self.snapshot_time = None
+        self.dispatched_seq = 0
+        self.counters = {'late': 0, 'stale': 0, 'skipped': 0, 'failed': 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.next_fetch is None:
+                        self.cond.wait()
+                        continue
+                    delay = self.next_fetch - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+            try:
+                snapshot = self.fetch()
+            except BaseException, e:
+                # includes SystemExit, which would otherwise quietly end the worker
+                with self.cond:
+                    self.counters['failed'] += 1
+                    self.next_fetch = None
+                self.log_error('Prefetch failed: {}'.format(e))
+                continue
+            with self.cond:
+                if self.snapshot_seq > self.dispatched_seq:
+                    self.counters['skipped'] += 1
+                self.snapshot = snapshot
+                self.snapshot_seq += 1
+                self.snapshot_time = time.time()
+                # nothing more to do until the next read schedules a fetch
+                if self.next_fetch is not None and self.next_fetch <= self.snapshot_time:
+                    self.next_fetch = None
+
+    def collect(self):
+        """
+        called from the read callback, returns the latest unseen snapshot or None (late or stale)
+        and schedules the fetch for the next interval
+        """
+        now = time.time()
+        with self.cond:
+            if self.last_read is not None:
+                period = now - self.last_read
+                self.period = period if self.period is None else self.period * 0.8 + period * 0.2
+            self.last_read = now
+
+            if self.period:
+                self.next_fetch = now + max(0, self.period - self.lead)
+            elif self.next_fetch is None:
+                # the first fetch failed, try again straight away
+                self.next_fetch = now
+            self.cond.notify()
+
+            snapshot = None
+            max_age = self.max_age or (2 * self.period if self.period else None)
+            if self.snapshot_seq == self.dispatched_seq:
+                self.counters['late'] += 1
+            elif max_age and now - self.snapshot_time > max_age:
+                self.counters['stale'] += 1
+                self.dispatched_seq = self.snapshot_seq
+            else:
+                snapshot = self.snapshot
+                self.dispatched_seq = self.snapshot_seq
+            # dispatched (or discarded), don't hold on to it
+            if self.dispatched_seq == self.snapshot_seq:
+                self.snapshot = None
+
+        if self.thread is None:
+            self.start()
+        return(snapshot)
+
+# END
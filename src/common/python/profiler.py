@@ -0,0 +1,90 @@
+#
+# Opt-in profiling of the collectd read callback
+#
+
+import cProfile
+import os
+import pstats
+import time
+
+
+class ReadProfiler(object):
+    """
+    profiles the read callback with cProfile for a number of intervals, then writes the aggregated
+    profile to output (pstats format, e.g. python -m pstats <file>) and a text summary next to it.
+
+    profiling starts at startup (enabled) or whenever trigger_file appears; creating trigger_file
+    while profiling stops early and writes what has been collected. the file is removed once seen.
+    a signal is not used, collectd runs python callbacks on its own threads and python signal
+    handlers only ever run on the interpreter's main thread.
+
+    only the read callback's thread is profiled, fetches made by prefetch or target worker threads
+    are not included.
+
+    output may contain {pid} and {time}
+    """
+
+    def __init__(self, output, intervals=10, trigger_file=None, enabled=False, log_info=None, log_error=None):
+        super(ReadProfiler, self).__init__()
+        self.output = output
+        self.intervals = max(1, int(intervals))
+        self.trigger_file = trigger_file
+        self.log_info = log_info or (lambda msg: None)
+        self.log_error = log_error or (lambda msg: None)
+        self.profile = None
+        self.remaining = 0
+        if enabled:
+            self.start()
+
+    def start(self):
+        self.profile = cProfile.Profile()
+        self.remaining = self.intervals
+        self.log_info('Profiling the next {} reads'.format(self.intervals))
+
+    def stop(self):
+        """ write the profile collected so far """
+        profile = self.profile
+        self.profile = None
+        self.remaining = 0
+        filename = self.output.format(pid=os.getpid(), time=int(time.time()))
+        try:
+            profile.dump_stats(filename)
+            with open('{}.txt'.format(filename), 'w') as f:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(50)
+                stats.sort_stats('tottime').print_stats(50)
+        except (IOError, OSError), e:
+            self.log_error('Unable to write profile "{}": {}'.format(filename, e))
+            return
+        self.log_info('Profile written to {}'.format(filename))
+
+    def triggered(self):
+        """ True (once) if the trigger file exists """
+        if not self.trigger_file or not os.path.exists(self.trigger_file):
+            return(False)
+        try:
+            os.remove(self.trigger_file)
+        except OSError, e:
+            self.log_error('Unable to remove profile trigger file "{}", profiling not toggled: {}'.format(self.trigger_file, e))
+            return(False)
+        return(True)
+
+    def run(self, func):
+        """ call func, profiled if profiling is active """
+        if self.triggered():
+            if self.profile is None:
+                self.start()
+            else:
+                self.stop()
+
+        if self.profile is None:
+            return(func())
+
+        try:
+            return(self.profile.runcall(func))
+        finally:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.stop()
+
+# END
@@ -0,0 +1,69 @@
+#
+# PUTVAL output for the exec versions of the plugins (cadvisor-cli, mesos-cli)
+#
+
+import errno
+import math
+import sys
+import time
+
+from resilience import TransientError
+
+
+class PutvalWriter(object):
+    """
+    buffers the PUTVAL lines of an interval and writes them to collectd (stdout) in one go with flush(),
+    instead of a write (and, on a pipe, a flush) per value
+    """
+
+    def __init__(self, stream=None):
+        super(PutvalWriter, self).__init__()
+        self.stream = stream or sys.stdout
+        self.lines = []
+        self.counters = {'lines': 0, 'flushes': 0}
+
+    def putval(self, identifier, interval, timestamp, values):
+        """ identifier is host/plugin[-plugin_instance]/type[-type_instance], timestamp None for 'now' """
+        self.lines.append('PUTVAL {} INTERVAL={} {}:{}\n'.format(identifier, interval, '{:.3f}'.format(timestamp) if timestamp else 'N',
+                                                                 ':'.join(map(str, values))))
+
+    def flush(self):
+        if not self.lines:
+            return
+        lines = self.lines
+        self.lines = []
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+        self.counters['lines'] += len(lines)
+        self.counters['flushes'] += 1
+
+
+def run_resident(collect, writer, interval, once=False, log_warning=None):
+    """
+    call collect() every interval seconds (aligned on the start time, late runs skip the missed ticks),
+    flushing writer after each call. a TransientError skips the interval. returns the exit status:
+    0 after a single run (once) or when collectd closes the pipe (it is shutting down or restarting us).
+    """
+    log_warning = log_warning or (lambda msg: None)
+    next_run = time.time()
+    while True:
+        try:
+            collect()
+        except TransientError, e:
+            log_warning('Interval skipped: {}'.format(e))
+        try:
+            writer.flush()
+        except IOError, e:
+            if e.errno == errno.EPIPE:
+                return(0)
+            raise
+        if once:
+            return(0)
+
+        next_run += interval
+        now = time.time()
+        if next_run <= now:
+            next_run += math.ceil((now - next_run) / interval) * interval
+        time.sleep(next_run - now)
+
+# END
@@ -0,0 +1,49 @@
+#
+# Per second rates of cumulative counters
+#
+
+
+class RateEngine(object):
+    """
+    keeps the previous (timestamp, values) of every series, grouped by container so all of a
+    container's state can be dropped at once when the container goes away (a restarted container
+    has a new id, so it starts over with fresh series)
+    """
+
+    def __init__(self):
+        super(RateEngine, self).__init__()
+        self.state = {}
+        self.counters = {'resets': 0}
+
+    def rate(self, container_key, series_key, timestamp, values):
+        """
+        per second rate of each of values since the previous sample of the series
+        None for the first sample of a series, after a counter reset (any value went down, the
+        new sample becomes the baseline) or when the sample is not newer than the previous one
+        """
+        series = self.state.get(container_key, None)
+        if series is None:
+            series = self.state[container_key] = {}
+        previous = series.get(series_key, None)
+        if previous is None:
+            series[series_key] = (timestamp, values)
+            return(None)
+
+        previous_timestamp, previous_values = previous
+        elapsed = timestamp - previous_timestamp
+        if elapsed <= 0:
+            return(None)
+        series[series_key] = (timestamp, values)
+
+        rates = []
+        for value, previous_value in zip(values, previous_values):
+            if value < previous_value:
+                self.counters['resets'] += 1
+                return(None)
+            rates.append((value - previous_value) / elapsed)
+        return(rates)
+
+    def evict(self, container_key):
+        self.state.pop(container_key, None)
+
+# END
@@ -0,0 +1,91 @@
+#
+# Retries and circuit breaking for the cadvisor, mesos and docker calls made every interval
+#
+
+import random
+import threading
+import time
+
+
+class TransientError(Exception):
+    """
+    a fetch failed in a way which may well succeed next interval (timeout, refused connection,
+    endpoint restarting, docker error), the interval is skipped rather than the plugin stopped
+    """
+    pass
+
+
+def retry(func, attempts=3, delay=0.2, max_delay=2.0, retry_on=(Exception,), give_up_on=(), log=None):
+    """
+    call func, retrying exceptions in retry_on up to attempts times in all, sleeping a random
+    (full jitter) time of up to delay * 2^attempt (at most max_delay) between attempts
+    exceptions in give_up_on are raised straight away (e.g. timeouts, which already took their time),
+    the last exception is raised when every attempt has failed
+    """
+    attempt = 0
+    while True:
+        try:
+            return(func())
+        except give_up_on:
+            raise
+        except retry_on, e:
+            attempt += 1
+            if attempt >= attempts:
+                raise
+            pause = random.uniform(0, min(max_delay, delay * (2 ** attempt)))
+            if log is not None:
+                log('Attempt {} of {} failed ({}), retrying in {:.2f}s'.format(attempt, attempts, e, pause))
+            time.sleep(pause)
+
+
+class CircuitBreaker(object):
+    """
+    stops calling an endpoint which keeps failing. after threshold consecutive failures the circuit
+    opens and calls are refused for reset_timeout seconds, then one trial call is let through
+    (half open). success closes the circuit, failure opens it again for twice as long (up to max_timeout).
+    """
+
+    def __init__(self, threshold=3, reset_timeout=30, max_timeout=300):
+        super(CircuitBreaker, self).__init__()
+        self.threshold = max(1, int(threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.max_timeout = float(max_timeout)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.timeout = self.reset_timeout
+        self.opened = None
+        self.counters = {'opened': 0, 'refused': 0}
+
+    def allow(self):
+        """ True if a call may be made now """
+        with self.lock:
+            if self.opened is None:
+                return(True)
+            if time.time() - self.opened >= self.timeout:
+                # half open, this call is the trial, the next ones wait for its outcome
+                self.opened = time.time()
+                return(True)
+            self.counters['refused'] += 1
+            return(False)
+
+    def is_open(self):
+        with self.lock:
+            return(self.opened is not None)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.timeout = self.reset_timeout
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened is not None:
+                self.opened = time.time()
+                self.timeout = min(self.timeout * 2, self.max_timeout)
+            elif self.failures >= self.threshold:
+                self.opened = time.time()
+                self.counters['opened'] += 1
+
+# END
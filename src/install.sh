@@ -9,6 +9,8 @@ mkdir -p ${DEST}/opt/collectd/csv
 mkdir -p ${DEST}/opt/collectd/python
 touch ${DEST}/opt/collectd/python/__init__.py
 
+cp common/python/*.py ${DEST}/opt/collectd/python/
+
 cp cadvisor/cadvisor-cli ${DEST}/opt/collectd/
 chown nobody ${DEST}/opt/collectd/cadvisor-cli
 chmod +x ${DEST}/opt/collectd/cadvisor-cli
@@ -1,5 +1,10 @@
-from mesos_collectd import MesosCollectd
+from mesos_collectd import MesosCollectd, dispatch_read_metrics, output_writer, read_config
+from multi_target import MultiTarget
+from prefetch import Prefetcher
+from profiler import ReadProfiler
+from resilience import TransientError
 import collectd
+import time
 
 
 class MesosSlave(MesosCollectd):
@@ -13,49 +18,77 @@ class MesosSlave(MesosCollectd):
 # mesos master metrics collector python plugin for collectd
 #
 client = None
+collector = None
+prefetcher = None
+self_metrics = False
+profiler = None
+# graphite/influxdb writer (output), None when dispatching to collectd
+writer = None
 
 
 def configurator(collectd_conf):
-    """
-    configure the mesos metrics collector
-    options:
-        host: ip of target mesos host
-        port: port of target mesos host
-        trackingname: vanity host name to use for master tracking
-        separator: separator character for mesos metric names
-        configfile: metric configuration file
-    """
-    global client
-
-    config = {'port': 5051}
-    for item in collectd_conf.children:
-        key = item.key.lower()
-        val = item.values[0]
-        if key == 'host':
-            config['host'] = val
-        elif key == 'port':
-            config['port'] = int(val)
-        elif key == 'separator':
-            config[key] = val
-# not applicable to slave
-#        elif key == 'trackingname':
-#            config['tracking_name'] = val
-        elif key == 'configfile':
-            config['config_file'] = val
-        else:
-            collectd.warning('mesos-slave plugin: unknown config key {} = {}'.format(item.key, val))
+    """ configure the mesos metrics collector, see mesos_collectd.read_config for the options """
+    global client, collector, prefetcher, self_metrics, profiler, writer
+
+    config = read_config(collectd_conf, 'mesos-slave', 5051, False)
+
+    if config.get('targets', None) or config.get('targets_file', None):
+        def target_client(target):
+            return(MesosSlave(dict(config, host=target['host'], port=target['port'], target_name=target['name'])))
+        collector = MultiTarget(target_client, config['port'], config.get('targets', None), config.get('targets_file', None),
+                                config.get('target_workers', 8), 'fetch_metrics', collectd.error)
+    else:
+        client = MesosSlave(config)
 
-    #
-    # this cannot be overridden
-    #
-    config['master'] = False
+    self_metrics = config.get('self_metrics', False)
+    writer = output_writer(config.get('output', None))
 
-    client = MesosSlave(config)
+    if config.get('profile', False) or config.get('profile_trigger_file', None):
+        profiler = ReadProfiler(config.get('profile_output', '/tmp/mesos-slave-{pid}-{time}.prof'), config.get('profile_intervals', 10),
+                                config.get('profile_trigger_file', None), config.get('profile', False), collectd.info, collectd.error)
+
+    if config.get('prefetch', False):
+        fetch = collector.fetch if collector else client.fetch_metrics
+        prefetcher = Prefetcher(fetch, config.get('prefetch_lead', 1.0), config.get('prefetch_max_age', None), collectd.error)
 
 
 def reader():
-    global client
-    client.emit_metrics(client.fetch_metrics())
+    global profiler
+    if profiler is not None:
+        profiler.run(read)
+    else:
+        read()
+
+
+def read():
+    global client, collector, prefetcher, self_metrics, writer
+    start = time.time()
+    if prefetcher is not None:
+        # only dispatch the snapshot fetched ahead of this read, never wait on mesos
+        metrics = prefetcher.collect()
+        if metrics is None:
+            collectd.warning('No new mesos snapshot ready, interval skipped {}'.format(prefetcher.counters))
+    elif collector is not None:
+        metrics = collector.fetch()
+    else:
+        try:
+            metrics = client.fetch_metrics()
+        except TransientError, e:
+            # mesos restarting, failing over... try again next interval
+            collectd.warning('Interval skipped: {}'.format(e))
+            metrics = None
+
+    if metrics is not None:
+        if collector is not None:
+            collector.emit(metrics)
+        else:
+            client.emit_metrics(metrics)
+
+    if self_metrics:
+        dispatch_read_metrics('slave', time.time() - start, prefetcher, writer)
+
+    if writer is not None:
+        writer.flush()
 
 
 collectd.register_config(configurator)
@@ -8,6 +8,11 @@ import urllib2
 import socket
 import docker
 import re
+import time
+
+from change_filter import ChangeFilter
+from http_pool import shared_pool
+from resilience import CircuitBreaker, TransientError, retry
 
 #
 # collectd python docs
@@ -31,6 +36,8 @@ class Mesos(object):
         self.active_master_key = 'master/elected'
         self.tracking_enabled = False
         self.tracking_name = self.config.get('tracking_name', None)
+        # set when this is one of several targets polled by a single plugin instance
+        self.target_name = self.config.get('target_name', None)
 
         self.port = self.config['port']
         # get mesos host (ip) from docker if configured to do so
@@ -39,7 +46,27 @@ class Mesos(object):
         else:
             self.host = self.config['host']
 
-        self.url = 'http://{}:{}/metrics/snapshot'.format(self.host, self.port)
+        self.path = '/metrics/snapshot'
+        self.url = 'http://{}:{}{}'.format(self.host, self.port, self.path)
+        # persistent connections to mesos (shared with any other plugin instances)
+        self.http_pool = shared_pool(self.config.get('pool_size', None), self.config.get('idle_timeout', None))
+        # the snapshot carries no timestamp, with sample_timestamps values are stamped with the time the
+        # fetch completed, otherwise sample_time stays None: collectd stamps the values when they are dispatched
+        self.sample_timestamps = self.config.get('sample_timestamps', False)
+        self.sample_time = None
+        # change-only emission, unchanged values (within deadband) are only sent every heartbeat intervals
+        self.change_filter = None
+        if self.config.get('change_only', False):
+            self.change_filter = ChangeFilter(self.config.get('deadband', 0), self.config.get('heartbeat', 10))
+        # the plugin's own cost, dispatched every interval under collector_plugin
+        self.self_metrics = self.config.get('self_metrics', False)
+        self.collector_plugin = 'mesos_collector'
+        self.collector_stats = {}
+        # failed connections are retried within the interval, after circuit_threshold failed intervals
+        # mesos is left alone for circuit_reset seconds, fetch_metrics raises TransientError to skip an interval
+        self.retry_attempts = self.config.get('retry_attempts', 3)
+        self.retry_delay = self.config.get('retry_delay', 0.2)
+        self.circuit = CircuitBreaker(self.config.get('circuit_threshold', 3), self.config.get('circuit_reset', 30))
         self.mesos_separator = '/'
         self.separator = self.config['separator'] if 'separator' in self.config else None
 
@@ -85,32 +112,56 @@ class Mesos(object):
         self.log('{name}: {msg}'.format(name=self.name, msg=message))
 
     @abstractmethod
-    def dispatch_metric(self, metric_type, metric_type_instance, metric_value):
+    def dispatch_metric(self, metric_type, metric_type_instance, metric_value, plugin=None):
         """
         send metrics to the target output
         intended to be overridden - e.g. by an abstraction to collectd's Values.dispatch()
+        plugin: optional, defaults to self.plugin (the plugin's own metrics use collector_plugin)
         """
         pass
 
+    def dispatch_batch(self, records):
+        """
+        send an interval's records, (type, type_instance, value, plugin) tuples, calling dispatch_metric() for each
+        intended to be overridden by backends which can output a whole batch more efficiently
+        """
+        dispatch_metric = self.dispatch_metric
+        for metric_type, metric_type_instance, metric_value, plugin in records:
+            dispatch_metric(metric_type, metric_type_instance, metric_value, plugin)
+
     def fetch_metrics(self):
         """
         Retrieve metrics from mesos endpoint
         Convert returned JSON to python data structure
         Return metrics
+        Raises TransientError when the interval has to be skipped
         """
         metrics = {}
+        if not self.circuit.allow():
+            raise TransientError('Mesos "{}" keeps failing, not contacted for now'.format(self.url))
         try:
-            response = urllib2.urlopen(self.url, None, 5)
-            metrics = json.loads(response.read())
+            start = time.time()
+            body = retry(lambda: self.http_pool.fetch(self.host, self.port, self.path, 5), self.retry_attempts, self.retry_delay,
+                         retry_on=(IOError,), give_up_on=(urllib2.HTTPError, socket.timeout), log=self.log_warning)
+            fetched = time.time()
+            metrics = json.loads(body)
+            parsed = time.time()
+            if self.sample_timestamps:
+                self.sample_time = parsed
+            self.collector_stats = {'fetch': fetched - start, 'parse': parsed - fetched, 'bytes': len(body)}
+        except urllib2.HTTPError, e:
+            self.circuit.failure()
+            raise TransientError('Server "{}" unable to fulfill request {}'.format(self.url, e.code))
         except urllib2.URLError, e:
-            if hasattr(e, 'reason'):
-                self.log_error('Failed to reach server "{}", reason {}'.format(self.url, e.reason))
-            elif hasattr(e, 'code'):
-                self.log_error('Server "{}" unable to fulfill request {}'.format(self.url, e.code))
-            sys.exit(1)
+            self.circuit.failure()
+            raise TransientError('Failed to reach server "{}", reason {}'.format(self.url, e.reason))
         except socket.timeout:
-            self.log_error('Timeout connecting to "{}"'.format(self.url))
-            sys.exit(1)
+            self.circuit.failure()
+            raise TransientError('Timeout connecting to "{}"'.format(self.url))
+        except (IOError, ValueError), e:
+            self.circuit.failure()
+            raise TransientError('Error reading "{}": {}'.format(self.url, e))
+        self.circuit.success()
 
         return(metrics)
 
@@ -120,8 +171,9 @@ class Mesos(object):
             set metric type based on metrics configuration
             set metric type instance to metric name from mesos
             skip metrics configured with a type of 'ignore'
+            optionally, skip metrics which have not changed since they were last sent (change-only)
             optionally, change type instance separator from '/' to a user supplied separator
-            call abstract dispatch_metric method to output metric
+            output the records as one batch (dispatch_batch)
         """
         mesos_sep = self.mesos_separator
         user_sep = self.separator
@@ -130,10 +182,18 @@ class Mesos(object):
 
         # disable tracking by default (master may have changed since last run)
         # enable it if this is a) a master, b) the active master, and c) a tracking name has been set
+        tracking_enabled = self.tracking_enabled
         self.tracking_enabled = False
         if self.config['master'] and self.tracking_name:
             self.tracking_enabled = self.active_master_key in metrics and metrics[self.active_master_key] == 1
 
+        # a newly elected master has to send everything under the tracking name
+        change_filter = self.change_filter
+        if change_filter is not None and self.tracking_enabled != tracking_enabled:
+            change_filter.clear()
+
+        start = time.time()
+        records = []
         for metric in metrics:
             try:
                 metric_type = metrics_cfg[metric]
@@ -142,7 +202,22 @@ class Mesos(object):
             except KeyError:
                 metric_type = default_metric_type
             metric_type_instance = metric.replace(mesos_sep, user_sep) if user_sep else metric
-            self.dispatch_metric(metric_type=metric_type, metric_type_instance=metric_type_instance, metric_value=metrics[metric])
+            if change_filter is not None and not change_filter.changed(None, (metric_type, metric_type_instance), (metrics[metric],)):
+                continue
+            records.append((metric_type, metric_type_instance, metrics[metric], None))
+        self.dispatch_batch(records)
+        dispatched = len(records)
+
+        if self.self_metrics:
+            stats = self.collector_stats
+            collector_plugin = self.collector_plugin
+            records = [('duration', key, stats[key], collector_plugin) for key in ('fetch', 'parse') if key in stats]
+            if 'bytes' in stats:
+                records.append(('bytes', 'bytes', stats['bytes'], collector_plugin))
+            records.append(('duration', 'emit', time.time() - start, collector_plugin))
+            records.append(('count', 'metrics_seen', len(metrics), collector_plugin))
+            records.append(('count', 'values', dispatched, collector_plugin))
+            self.dispatch_batch(records)
 
     def get_host_from_docker(self):
         """
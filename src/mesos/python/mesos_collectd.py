@@ -1,5 +1,8 @@
 from mesos import Mesos
+from direct_writer import shared_writer
+from http_pool import shared_pool
 import collectd
+import sys
 
 
 class MesosCollectd(Mesos):
@@ -7,6 +10,10 @@ class MesosCollectd(Mesos):
     def __init__(self, config):
         super(MesosCollectd, self).__init__(config)
         self.name = self.__class__.__name__
+        # (plugin, type, type instance) -> (Values, tracking Values), built once and reused for every dispatch
+        self.series = {}
+        # values written straight to graphite/influxdb instead of dispatched to collectd
+        self.writer = output_writer(self.config.get('output', None))
 
     def log_error(self, msg):
         collectd.error(msg)
@@ -23,14 +30,221 @@ class MesosCollectd(Mesos):
     def log_debug(self, msg):
         collectd.debug(msg)
 
-    def dispatch_metric(self, metric_type, metric_type_instance, metric_value):
+    def gen_series(self, metric_type, metric_type_instance, plugin=None):
+        if self.writer is not None:
+            metric = self.writer.series(self.target_name or self.writer.hostname, plugin or self.plugin, self.plugin_instance,
+                                        metric_type, metric_type_instance)
+            tracking_metric = None
+            if self.tracking_name and plugin is None:
+                tracking_metric = self.writer.series(self.tracking_name, self.plugin, self.plugin_instance, metric_type, metric_type_instance)
+            return((metric, tracking_metric))
+
         metric = collectd.Values()
-        metric.plugin = self.plugin
+        if self.target_name:
+            metric.host = self.target_name
+        metric.plugin = plugin or self.plugin
         metric.plugin_instance = self.plugin_instance
         metric.type = metric_type
         metric.type_instance = metric_type_instance
+        tracking_metric = None
+        if self.tracking_name and plugin is None:
+            tracking_metric = collectd.Values()
+            tracking_metric.host = self.tracking_name
+            tracking_metric.plugin = self.plugin
+            tracking_metric.plugin_instance = self.plugin_instance
+            tracking_metric.type = metric_type
+            tracking_metric.type_instance = metric_type_instance
+        return((metric, tracking_metric))
+
+    def dispatch_metric(self, metric_type, metric_type_instance, metric_value, plugin=None):
+        series_key = (plugin, metric_type, metric_type_instance)
+        try:
+            metric, tracking_metric = self.series[series_key]
+        except KeyError:
+            metric, tracking_metric = self.series[series_key] = self.gen_series(metric_type, metric_type_instance, plugin)
+        if self.writer is not None:
+            self.writer.write(metric, self.sample_time, [metric_value])
+            if self.tracking_enabled and tracking_metric is not None:
+                self.writer.write(tracking_metric, self.sample_time, [metric_value])
+            return
         metric.values = [metric_value]
+        metric.time = self.sample_time or 0
         metric.dispatch()
-        if self.tracking_enabled:
-            metric.host = self.tracking_name
+        if self.tracking_enabled and tracking_metric is not None:
+            tracking_metric.values = metric.values
+            tracking_metric.time = metric.time
+            tracking_metric.dispatch()
+
+    def dispatch_batch(self, records):
+        series = self.series
+        gen_series = self.gen_series
+        tracking_enabled = self.tracking_enabled
+        sample_time = self.sample_time
+        items = [] if self.writer is not None else None
+        dispatch_time = sample_time or 0
+        for metric_type, metric_type_instance, metric_value, plugin in records:
+            series_key = (plugin, metric_type, metric_type_instance)
+            try:
+                metric, tracking_metric = series[series_key]
+            except KeyError:
+                metric, tracking_metric = series[series_key] = gen_series(metric_type, metric_type_instance, plugin)
+            if items is not None:
+                items.append((metric, [metric_value]))
+                if tracking_enabled and tracking_metric is not None:
+                    items.append((tracking_metric, [metric_value]))
+                continue
+            metric.values = [metric_value]
+            metric.time = dispatch_time
             metric.dispatch()
+            if tracking_enabled and tracking_metric is not None:
+                tracking_metric.values = metric.values
+                tracking_metric.time = dispatch_time
+                tracking_metric.dispatch()
+        if items:
+            self.writer.write_all(items, sample_time)
+
+
+def output_writer(output):
+    """ the shared writer of an output configuration, None to dispatch to collectd, an invalid one stops the plugin """
+    try:
+        return(shared_writer(output, collectd.error))
+    except ValueError, e:
+        collectd.error('Invalid output configuration: {}'.format(e))
+        sys.exit(1)
+
+
+def parse_bool(val):
+    """ a collectd config boolean, given bare (true/false) or as a string ("false", "off", "0"...) """
+    if isinstance(val, basestring):
+        text = val.strip().lower()
+        if text in ('true', 'yes', 'on', '1'):
+            return(True)
+        if text in ('false', 'no', 'off', '0', ''):
+            return(False)
+        raise ValueError('invalid boolean "{}"'.format(val))
+    return(bool(val))
+
+
+def identity(val):
+    return(val)
+
+# collectd config key (lowercase) -> (config key, conversion)
+CONFIG_KEYS = {
+    'host': ('host', identity),
+    'port': ('port', int),
+    'separator': ('separator', identity),
+    'trackingname': ('tracking_name', identity),
+    'configfile': ('config_file', identity),
+    'poolsize': ('pool_size', int),
+    'idletimeout': ('idle_timeout', float),
+    'prefetch': ('prefetch', parse_bool),
+    'prefetchlead': ('prefetch_lead', float),
+    'prefetchmaxage': ('prefetch_max_age', float),
+    'targetsfile': ('targets_file', identity),
+    'targetworkers': ('target_workers', int),
+    'changeonly': ('change_only', parse_bool),
+    'deadband': ('deadband', float),
+    'heartbeat': ('heartbeat', int),
+    'selfmetrics': ('self_metrics', parse_bool),
+    'profile': ('profile', parse_bool),
+    'profileintervals': ('profile_intervals', int),
+    'profiletriggerfile': ('profile_trigger_file', identity),
+    'profileoutput': ('profile_output', identity),
+    'retryattempts': ('retry_attempts', int),
+    'retrydelay': ('retry_delay', float),
+    'circuitthreshold': ('circuit_threshold', int),
+    'circuitreset': ('circuit_reset', float),
+    'sampletimestamps': ('sample_timestamps', parse_bool),
+}
+
+# collectd config key (lowercase) -> (config['output'] key, conversion)
+OUTPUT_KEYS = {
+    'output': ('type', identity),
+    'outputhost': ('host', identity),
+    'outputport': ('port', int),
+    'outputhostname': ('hostname', identity),
+    'outputprefix': ('prefix', identity),
+    'outputdatabase': ('database', identity),
+}
+
+
+def read_config(collectd_conf, plugin_name, port, master):
+    """
+    the configuration of the mesos-master (master True) or mesos-slave plugin from its collectd module block
+    options:
+        host: ip of target mesos host
+        port: port of target mesos host (default port)
+        trackingname: vanity host name to use for master tracking (master only)
+        separator: separator character for mesos metric names
+        configfile: metric configuration file
+        poolsize: idle keep-alive connections kept per endpoint
+        idletimeout: seconds before an idle keep-alive connection is closed
+        prefetch: fetch in the background ahead of each read
+        prefetchlead: seconds before the next read to start the prefetch
+        prefetchmaxage: seconds after which a prefetched snapshot is too old to dispatch
+        targets: one or more 'host[:port]' to poll (concurrently) instead of host
+        targetsfile: yaml list of targets, re-read when it changes
+        targetworkers: number of targets fetched at the same time
+        changeonly: only send values which have changed (see deadband, heartbeat)
+        deadband: fraction of the value last sent within which a value counts as unchanged
+        heartbeat: send unchanged values at least every heartbeat intervals
+        selfmetrics: dispatch the plugin's own timings and counts (plugin mesos_collector)
+        profile: profile the first profileintervals reads
+        profileintervals: number of reads to profile (default 10)
+        profiletriggerfile: profile the next profileintervals reads whenever this file appears
+        profileoutput: profile file name, may contain {pid} and {time}
+        retryattempts: attempts at connecting to mesos within an interval (default 3)
+        retrydelay: base delay (seconds) between attempts, with jitter (default 0.2)
+        circuitthreshold: failed intervals after which mesos is left alone for circuitreset seconds (default 3)
+        circuitreset: seconds mesos is left alone for, doubled while it keeps failing (default 30)
+        sampletimestamps: stamp the values with the time the snapshot was fetched rather than leave it to collectd (default false)
+        output: collectd (default), graphite or influxdb, write the values straight to graphite/influxdb
+        outputhost, outputport: graphite/influxdb host and port (default 2003 graphite, 8086 influxdb)
+        outputhostname: host the values are attributed to (default: this host's name)
+        outputprefix: graphite path prefix
+        outputdatabase: influxdb database (default collectd)
+    """
+    config = {'port': port}
+    for item in collectd_conf.children:
+        key = item.key.lower()
+        val = item.values[0]
+        try:
+            if key == 'targets':
+                config['targets'] = config.get('targets', []) + list(item.values)
+            elif key in CONFIG_KEYS and (master or key != 'trackingname'):
+                name, convert = CONFIG_KEYS[key]
+                config[name] = convert(val)
+            elif key in OUTPUT_KEYS:
+                name, convert = OUTPUT_KEYS[key]
+                config.setdefault('output', {})[name] = convert(val)
+            else:
+                collectd.warning('{} plugin: unknown config key {} = {}'.format(plugin_name, item.key, val))
+        except ValueError, e:
+            collectd.error('{} plugin: invalid value for {}: {}'.format(plugin_name, item.key, e))
+            sys.exit(1)
+
+    #
+    # this cannot be overridden
+    #
+    config['master'] = master
+    return(config)
+
+
+def dispatch_read_metrics(plugin_instance, read_time, prefetcher=None, writer=None):
+    """
+    the plugin's own read callback duration, connection pool, prefetch and output counters
+    not tied to any one client (there is one per target when polling several)
+    """
+    values = [('duration', 'read', read_time)]
+    values.extend(('derive', 'pool_{}'.format(key), value) for key, value in shared_pool().stats().iteritems())
+    if prefetcher is not None:
+        values.extend(('derive', 'prefetch_{}'.format(key), value) for key, value in prefetcher.counters.items())
+    if writer is not None:
+        values.extend(('derive', 'output_{}'.format(key), value) for key, value in writer.counters.items())
+        writer.write_all([(writer.series(writer.hostname, 'mesos_collector', plugin_instance, metric_type, type_instance), [value])
+                          for metric_type, type_instance, value in values], None)
+        return
+
+    metric = collectd.Values(plugin='mesos_collector', plugin_instance=plugin_instance)
+    for metric_type, type_instance, value in values:
+        metric.dispatch(type=metric_type, type_instance=type_instance, values=[value])
@@ -0,0 +1,34 @@
+import json
+import os
+import sys
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'common', 'python'))
+
+from json_stream import iter_object_items
+
+
+class IterObjectItemsTest(unittest.TestCase):
+
+    def items(self, text, chunk_size):
+        return(list(iter_object_items(BytesIO(text.encode('ascii')), chunk_size)))
+
+    def test_numbers_cut_at_chunk_boundaries(self):
+        for text in ('{"a": 1.5, "b": 2}', '{"a": 2e3, "b": -0.25}', '{"long": 123456789, "x": [1, 2.5], "y": 1E-2}'):
+            expected = list(json.loads(text).items())
+            for chunk_size in range(1, len(text) + 1):
+                self.assertEqual(sorted(self.items(text, chunk_size)), sorted(expected), 'chunk_size {}: {}'.format(chunk_size, text))
+
+    def test_number_at_end_of_stream(self):
+        self.assertEqual(self.items('{"a":1}', 6), [('a', 1)])
+
+    def test_empty_object(self):
+        self.assertEqual(self.items('{ }', 1), [])
+
+    def test_truncated_stream(self):
+        self.assertRaises(ValueError, self.items, '{"a": {"b": 1', 4)
+
+
+if __name__ == '__main__':
+    unittest.main()